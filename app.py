@@ -1,8 +1,9 @@
 import streamlit as st
-from vector_store import search
-from replicate_llm import generate_marketing_image
+from vector_store import search, start_warmup, warmup_status
+from replicate_llm import VARIANT_ASPECT_RATIOS, get_generation_job, submit_generation, submit_variants
 import os
 import json
+import time
 from datetime import datetime
 
 st.set_page_config(
@@ -12,6 +13,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Load the encoder and index in the background while the page renders
+start_warmup()
+
 # ── Session state ─────────────────────────────────────────────────────────────
 if "dark_mode" not in st.session_state:
     st.session_state.dark_mode = True
@@ -20,6 +24,18 @@ if "history" not in st.session_state:
     st.session_state.history = []
 if "selected_idx" not in st.session_state:
     st.session_state.selected_idx = 0
+if "jobs" not in st.session_state:
+    # Generations still running: { "id": job id, "prompt": str, "label": str | None }
+    st.session_state.jobs = []
+if "batch_size" not in st.session_state:
+    # Images requested by the last Generate click, sizes the recent grid
+    st.session_state.batch_size = 1
+if "notice" not in st.session_state:
+    # (kind, message) shown once after a job finishes
+    st.session_state.notice = None
+
+# Seconds between checks on running generations
+JOB_POLL_SECONDS = 1.0
 
 
 # ── Theme CSS ─────────────────────────────────────────────────────────────────
@@ -342,6 +358,19 @@ section[data-testid="stSidebar"] > div:first-child {{
     background: {success};
     box-shadow: 0 0 7px {success};
 }}
+.status-dot.loading {{
+    background: {accent};
+    box-shadow: 0 0 7px {accent};
+    animation: status-pulse 1.2s ease-in-out infinite;
+}}
+.status-dot.error {{
+    background: #f05a5a;
+    box-shadow: 0 0 7px #f05a5a;
+}}
+@keyframes status-pulse {{
+    0%, 100% {{ opacity: 1; }}
+    50% {{ opacity: .3; }}
+}}
 
 /* Text area */
 .stTextArea textarea {{
@@ -609,19 +638,39 @@ with st.sidebar:
 # ════════════════════════════════════════════════════════════════════
 
 # Header
-h_left, h_right = st.columns([3, 1])
-with h_left:
-    st.markdown("""
+# While the model warms up the header re-checks it every JOB_POLL_SECONDS;
+# once warm-up settles one full rerun redraws the page without polling
+model_warming = warmup_status()["state"] in ("cold", "loading")
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS if model_warming else None)
+def page_header():
+    model_state = warmup_status()["state"]
+    if model_warming and model_state not in ("cold", "loading"):
+        st.rerun()
+    if model_state == "ready":
+        status_cls, status_text = "", "Model ready"
+    elif model_state == "error":
+        status_cls, status_text = "error", "Model unavailable"
+    else:
+        status_cls, status_text = "loading", "Loading model…"
+
+    st.markdown(f"""
     <div style="display:flex;align-items:center;gap:12px;padding-top:2px;">
         <div class="page-title">👗 Fashion Marketing Studio</div>
         <span class="page-tag">AI · RAG</span>
         <div class="status-pill">
-            <div class="status-dot"></div>
-            Model ready
+            <div class="status-dot {status_cls}"></div>
+            {status_text}
         </div>
     </div>
     """, unsafe_allow_html=True)
 
+
+h_left, h_right = st.columns([3, 1])
+with h_left:
+    page_header()
+
 with h_right:
     mode_icon  = "🌙" if st.session_state.dark_mode else "☀️"
     mode_label = f"{mode_icon}  {'Dark' if st.session_state.dark_mode else 'Light'} Mode"
@@ -641,6 +690,12 @@ user_query = st.text_area(
     label_visibility="visible"
 )
 
+v_left, v_right = st.columns([1, 2])
+with v_left:
+    variant_count = st.select_slider("Variants", options=list(range(1, len(VARIANT_ASPECT_RATIOS) + 1)), value=1)
+with v_right:
+    vary = st.radio("Vary by", ["Seed", "Aspect ratio"], horizontal=True, disabled=variant_count == 1)
+
 generate_button = st.button("⚡  Generate Marketing Image")
 
 st.markdown("---")
@@ -650,18 +705,17 @@ if generate_button:
     if user_query.strip() == "":
         st.warning("⚠ Please enter a marketing request.")
     else:
-        with st.spinner("Generating your marketing visual…"):
-            try:
-                retrieved_chunks = search(user_query)
-                formatted_context = "\n\n".join(retrieved_chunks)
+        try:
+            hits = search(user_query)
 
-                final_prompt = f"""
-You are a professional fashion marketing designer.
+            # Only chunks that cleared the relevance thresholds go into the prompt
+            formatted_context = "\n\n".join(hit["text"] for hit in hits)
+            knowledge_block = f"Brand Knowledge:\n{formatted_context}\n\n" if hits else ""
 
-Brand Knowledge:
-{formatted_context}
+            final_prompt = f"""
+You are a professional fashion marketing designer.
 
-Create a high-quality Instagram marketing image for:
+{knowledge_block}Create a high-quality Instagram marketing image for:
 {user_query}
 
 Requirements:
@@ -671,37 +725,33 @@ Requirements:
 - Modern typography
 - Clear CTA button
 """
-                image_path = generate_marketing_image(final_prompt)
-
-                # ── Save to history ──
-                now = datetime.now()
-                st.session_state.history.append({
-                    "path":   image_path,
-                    "prompt": user_query.strip(),
-                    "time":   now.strftime("%I:%M %p"),
-                    "date":   now.strftime("%b %d, %Y"),
-                })
-                st.session_state.selected_idx = len(st.session_state.history) - 1
-
-                st.success("✅ Image generated successfully!")
-
-                st.markdown('<div class="section-label">Generated Image</div>', unsafe_allow_html=True)
-                st.markdown('<div class="img-frame-glow">', unsafe_allow_html=True)
-                st.image(image_path, use_container_width=True)
-                st.markdown('</div>', unsafe_allow_html=True)
-
-                with open(image_path, "rb") as file:
-                    st.download_button(
-                        label="⬇  Download Image",
-                        data=file,
-                        file_name=os.path.basename(image_path),
-                        mime="image/png"
-                    )
-
-            except Exception as e:
-                st.error(f"❌ Error generating image: {e}")
-
-elif st.session_state.history and st.session_state.selected_idx < len(st.session_state.history):
+            # Runs in the background; the page stays usable while it renders.
+            # Variants of one prompt are generated side by side.
+            if variant_count == 1:
+                jobs = [submit_generation(final_prompt)]
+            else:
+                jobs = submit_variants(final_prompt, variant_count, "seed" if vary == "Seed" else "aspect_ratio")
+            for job in jobs:
+                st.session_state.jobs.append({"id": job.id, "prompt": user_query.strip(), "label": job.label})
+            st.session_state.batch_size = len(jobs)
+
+        except Exception as e:
+            st.error(f"❌ Error generating image: {e}")
+
+
+if st.session_state.jobs:
+    count = len(st.session_state.jobs)
+    st.info(f"⏳ Generating {count} image{'s' if count > 1 else ''}… each one appears under Recent Generations as soon as it is ready.")
+
+if st.session_state.notice:
+    kind, message = st.session_state.notice
+    st.session_state.notice = None
+    if kind == "success":
+        st.success(message)
+    else:
+        st.error(message)
+
+if st.session_state.history and st.session_state.selected_idx < len(st.session_state.history):
     # Show selected history item
     entry = st.session_state.history[st.session_state.selected_idx]
     img_path = entry.get("path", "")
@@ -723,7 +773,7 @@ elif st.session_state.history and st.session_state.selected_idx < len(st.session
                 label="⬇  Download Image",
                 data=file,
                 file_name=os.path.basename(img_path),
-                mime="image/png"
+                mime=f"image/{os.path.splitext(img_path)[1].lstrip('.').replace('jpg', 'jpeg') or 'png'}"
             )
 
         st.markdown(f"""
@@ -748,7 +798,7 @@ elif st.session_state.history and st.session_state.selected_idx < len(st.session
         </div>
         """, unsafe_allow_html=True)
 
-else:
+elif not st.session_state.jobs:
     st.markdown("""
     <div class="empty-canvas">
         <div style="font-size:54px;opacity:.16;">🖼</div>
@@ -761,13 +811,61 @@ else:
     """, unsafe_allow_html=True)
 
 # ── Recent grid at bottom ─────────────────────────────────────────────────────
-if st.session_state.history:
+def collect_finished_jobs():
+    # Move finished jobs into the history; True if any finished
+    finished = False
+    for entry in list(st.session_state.jobs):
+        job = get_generation_job(entry["id"])
+        if job is None or job.done():
+            st.session_state.jobs.remove(entry)
+            finished = True
+            if job is None:
+                continue
+            if job.error:
+                st.session_state.notice = ("error", f"❌ Error generating image: {job.error}")
+                continue
+            now = datetime.now()
+            st.session_state.history.append({
+                "path":   job.path,
+                "prompt": entry["prompt"],
+                "label":  entry.get("label"),
+                "time":   now.strftime("%I:%M %p"),
+                "date":   now.strftime("%b %d, %Y"),
+            })
+            st.session_state.selected_idx = len(st.session_state.history) - 1
+            st.session_state.notice = ("success", "✅ Image generated successfully!")
+    return finished
+
+
+# While jobs run the grid re-runs on its own every JOB_POLL_SECONDS, showing
+# a placeholder per running job; each finished image triggers a full rerun
+# so it lands in the grid, the sidebar and the canvas right away
+@st.fragment(run_every=JOB_POLL_SECONDS if st.session_state.jobs else None)
+def recent_grid():
+    if collect_finished_jobs():
+        st.rerun()
+
+    running = [(entry, get_generation_job(entry["id"])) for entry in st.session_state.jobs]
+    slots = max(3, st.session_state.batch_size, len(running))
+    recent = list(reversed(st.session_state.history))[:slots - len(running)]
+    if not running and not recent:
+        return
+
     st.markdown('<div class="section-label">Recent Generations</div>', unsafe_allow_html=True)
-    recent = list(reversed(st.session_state.history))[:3]
-    cols = st.columns(3)
+    cols = st.columns(slots)
+    for col, (entry, job) in zip(cols, running):
+        with col:
+            st.markdown('''
+            <div class="variant-wrap">
+                <div class="thumb-placeholder"><div class="status-dot loading"></div></div>
+            </div>
+            ''', unsafe_allow_html=True)
+            elapsed = f"{int(time.time() - job.created)}s"
+            st.caption(" · ".join(part for part in (entry.get("label"), job.status, elapsed) if part))
+
     for idx, entry in enumerate(recent):
         real_idx = len(st.session_state.history) - 1 - idx
-        with cols[idx]:
+        with cols[len(running) + idx]:
             is_active = (real_idx == st.session_state.selected_idx)
             active_cls = "v-active" if is_active else ""
             img_path = entry.get("path", "")
@@ -778,4 +876,7 @@ if st.session_state.history:
                 st.markdown('<div class="thumb-placeholder">👗</div>', unsafe_allow_html=True)
             st.markdown('</div>', unsafe_allow_html=True)
             short = entry["prompt"][:32] + "…" if len(entry["prompt"]) > 32 else entry["prompt"]
-            st.caption(f"{entry['time']} · {short}")
\ No newline at end of file
+            st.caption(f"{entry['time']} · {entry['label'] if entry.get('label') else short}")
+
+
+recent_grid()
@@ -0,0 +1,298 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import time
+import zlib
+
+import faiss
+import numpy as np
+
+from index_factory import INDEX_TYPES, resolve_config
+from ingest import MANIFEST_FILE, stream_build
+from tagging import category_of, parse_filters
+
+DEFAULT_SIZES = (1_000, 100_000, 1_000_000)
+
+# Filtered searches measured on every index; a category of None stands for
+# the corpus file's own, the only partition of a synthetic corpus
+BENCHMARK_FILTERS = {
+    "audience": {"audience": "youth"},
+    "category": {"category": None},
+}
+
+# Vocabulary of the synthetic catalog rows, shaped like the knowledge base
+CATEGORIES = ["mens_wear", "women_wear", "footwear", "accessories", "kids_wear", "sportswear"]
+PRODUCTS = [
+    "oxford shirt", "street t-shirt", "slim jeans", "tailored blazer", "midi dress", "linen kurta",
+    "chelsea boots", "running shoes", "loafers", "block heels", "hoodie", "cargo pants", "bomber jacket",
+    "maxi skirt", "polo shirt", "denim jacket", "sneakers", "crossbody bag", "trench coat", "joggers",
+]
+COLORS = ["black", "white", "navy", "olive", "beige", "pastel pink", "maroon", "mustard", "sky blue", "charcoal"]
+MATERIALS = ["cotton", "linen", "denim", "leather", "suede", "wool", "silk", "polyester", "knit", "canvas"]
+FITS = ["slim", "regular", "oversized", "relaxed", "tailored"]
+AUDIENCES = ["college students", "working professionals", "fashion enthusiasts", "youth", "office commuters"]
+SEASONS = ["summer", "winter", "festive", "monsoon", "spring"]
+PLATFORMS = ["Instagram", "Reels", "LinkedIn", "YouTube", "Facebook"]
+
+
+def synthetic_row(rng, row_number):
+    category = rng.choice(CATEGORIES)
+    return {
+        "text": (
+            f"{rng.choice(FITS).title()} {rng.choice(COLORS)} {rng.choice(MATERIALS)} {rng.choice(PRODUCTS)}"
+            f" from {category.replace('_', ' ')}. For {rng.choice(AUDIENCES)}, {rng.choice(SEASONS)} collection."
+            f" SKU {category[:2].upper()}-{row_number:07d}. {rng.choice([10, 15, 20, 25, 30, 40])}% off"
+            f" on {rng.choice(PLATFORMS)}."
+        ),
+    }
+
+
+def synthetic_query(rng):
+    return (
+        f"{rng.choice(FITS)} {rng.choice(COLORS)} {rng.choice(PRODUCTS)} for {rng.choice(AUDIENCES)}"
+        f" {rng.choice(SEASONS)} campaign on {rng.choice(PLATFORMS)}"
+    )
+
+
+def write_corpus(path, size, seed=0):
+    """Write ``size`` synthetic catalog rows as JSONL, reusing an existing file."""
+    if os.path.exists(path):
+        return path
+    rng = random.Random(seed)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for row_number in range(size):
+            f.write(json.dumps(synthetic_row(rng, row_number)) + "\n")
+    os.replace(tmp_path, path)
+    return path
+
+
+class HashingEncoder:
+    """Offline stand-in for MiniLM: each word maps to a fixed random vector.
+
+    Texts that share words get nearby unit vectors, which gives the index
+    the clustered data it sees in production without downloading or
+    running a model, so million-chunk corpora build in minutes.
+    """
+
+    def __init__(self, dimension=384, buckets=1 << 16, seed=0):
+        self.dimension = dimension
+        self.buckets = buckets
+        self.table = np.random.default_rng(seed).standard_normal((buckets, dimension)).astype(np.float32)
+        self._rows = {}
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def _row(self, token):
+        row = self._rows.get(token)
+        if row is None:
+            row = self._rows[token] = zlib.crc32(token.encode("utf-8")) % self.buckets
+        return row
+
+    def encode(self, texts, batch_size=None, **kwargs):
+        rows = []
+        starts = []
+        for text in texts:
+            starts.append(len(rows))
+            rows.extend(self._row(token) for token in re.findall(r"\w+", text.lower()) or [""])
+        vectors = np.add.reduceat(self.table[rows], starts, axis=0) if starts else np.zeros((0, self.dimension))
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors.astype(np.float32)
+
+
+# Run in a fresh interpreter: in the benchmark process the index would
+# land in memory the build just freed and barely move the RSS
+_INDEX_RAM_SCRIPT = """
+import os, sys, faiss
+
+def rss():
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+before = rss()
+index = faiss.read_index(sys.argv[1])
+print(rss() - before)
+"""
+
+
+def _index_bytes_in_ram(path):
+    """RSS growth of a fresh process from loading the index at ``path``."""
+    result = subprocess.run([sys.executable, "-c", _INDEX_RAM_SCRIPT, path], capture_output=True, text=True,
+                            check=True)
+    return int(result.stdout.strip())
+
+
+def _folder_size(folder):
+    total = 0
+    for root, _, files in os.walk(folder):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _percentiles_ms(seconds):
+    return {f"p{p}": round(float(np.percentile(seconds, p)) * 1000, 3) for p in (50, 95, 99)}
+
+
+def _exact_neighbours(loaded, query_vectors, k, filters):
+    # Ground truth: every chunk the filter allows, found from the metadata
+    # rather than the tag lists, scored exactly on the partition vectors
+    categories, tag_masks = parse_filters(filters) if filters else (None, ())
+    accept = loaded.documents.acceptor(categories, tag_masks)
+    subsets = {}
+    for category in loaded.partitions.categories:
+        ids = np.asarray(loaded.partitions.get(category)[0])
+        subsets[category] = np.sort(ids[accept(ids)])
+    return loaded.partitions.search(query_vectors, k, subsets, exact=True)[1]
+
+
+def _measure(loaded, queries, query_vectors, k, mode, filters=None):
+    # One query at a time through retrieve_candidates, as search_many_local runs it
+    from vector_store import retrieve_candidates
+
+    latencies = []
+    found = []
+    for text, vector in zip(queries, query_vectors):
+        started = time.perf_counter()
+        dense, _ = retrieve_candidates(loaded, [text], lambda: vector[None, :], k, mode, filters)
+        latencies.append(time.perf_counter() - started)
+        found.append(dense[0][0])
+    return latencies, found
+
+
+def _recall(found, exact, k):
+    return round(float(np.mean([len(set(a) & set(b) - {-1}) / k for a, b in zip(found, exact)])), 4)
+
+
+def benchmark_index(corpus_path, folder, encoder, encoder_id, config, queries, query_vectors, k, batch_size):
+    """Build one index from ``corpus_path`` and measure it, see ``run()``."""
+    from vector_store import IndexHolder, retrieve_candidates
+
+    shutil.rmtree(folder, ignore_errors=True)
+    build = stream_build([corpus_path], folder, encoder, encoder_id, config,
+                         batch_size=batch_size, resume=False)
+    with open(os.path.join(folder, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        built_config = json.load(f)["index"]
+
+    index_ram = _index_bytes_in_ram(os.path.join(folder, "index.faiss"))
+    loaded = IndexHolder(folder).get()
+
+    latencies, found = _measure(loaded, queries, query_vectors, k, "dense")
+    started = time.perf_counter()
+    retrieve_candidates(loaded, queries, lambda: query_vectors, k, "dense")
+    batched_seconds = time.perf_counter() - started
+
+    filtered = {}
+    for name, filters in BENCHMARK_FILTERS.items():
+        filters = {key: category_of(corpus_path) if value is None else value for key, value in filters.items()}
+        filter_latencies, filter_found = _measure(loaded, queries, query_vectors, k, "dense", filters)
+        filtered[name] = {"filters": filters, "query_latency_ms": _percentiles_ms(filter_latencies),
+                          f"recall@{k}": _recall(filter_found, _exact_neighbours(loaded, query_vectors, k, filters),
+                                                 k)}
+    hybrid_latencies, _ = _measure(loaded, queries, query_vectors, k, "hybrid")
+
+    return {
+        "index": built_config,
+        "vectors": int(loaded.index.ntotal),
+        "build_seconds": build["seconds"],
+        "build_chunks_per_second": build["chunks_per_second"],
+        "index_bytes_on_disk": os.path.getsize(os.path.join(folder, "index.faiss")),
+        "folder_bytes_on_disk": _folder_size(folder),
+        "index_bytes_in_ram": index_ram,
+        "query_latency_ms": _percentiles_ms(latencies),
+        "batched_qps": round(len(query_vectors) / batched_seconds, 1),
+        f"recall@{k}": _recall(found, _exact_neighbours(loaded, query_vectors, k, None), k),
+        "filtered": filtered,
+        "hybrid_query_latency_ms": _percentiles_ms(hybrid_latencies),
+    }
+
+
+def run(sizes=DEFAULT_SIZES, index_types=INDEX_TYPES, workdir="benchmark_data", queries=200, k=10,
+        encoder=None, encoder_id="hashing", batch_size=1024, keep=False):
+    """Benchmark every index type on synthetic corpora of each size.
+
+    Per (size, index type) this reports build time and throughput, size of
+    the index file and the whole index folder on disk, resident memory of
+    the loaded index, single-query latency percentiles and batched QPS for
+    ``queries`` pre-encoded queries, and recall@``k`` against exact search.
+    Queries run through ``vector_store.retrieve_candidates`` in dense mode,
+    so IVF-PQ re-ranking is included, and again with each of
+    ``BENCHMARK_FILTERS`` (latency and recall against the exact filtered
+    neighbours) and in hybrid mode (latency only). Latencies cover the
+    search only, not query encoding.
+    """
+    encoder = encoder or HashingEncoder()
+    os.makedirs(workdir, exist_ok=True)
+    rng = random.Random(1)
+    query_texts = [synthetic_query(rng) for _ in range(queries)]
+    query_vectors = np.asarray(encoder.encode(query_texts), dtype=np.float32)
+
+    results = {
+        "commit": _commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "machine": {"platform": platform.platform(), "processor": platform.processor(),
+                    "cpus": os.cpu_count(), "faiss": faiss.__version__, "numpy": np.__version__},
+        "encoder": encoder_id,
+        "queries": queries,
+        "k": k,
+        "runs": [],
+    }
+    for size in sizes:
+        corpus_path = write_corpus(os.path.join(workdir, f"corpus-{size}.jsonl"), size)
+        for index_type in index_types:
+            print(f"Benchmarking {index_type} on {size} chunks...")
+            folder = os.path.join(workdir, f"index-{size}-{index_type}")
+            numbers = benchmark_index(corpus_path, folder, encoder, encoder_id, resolve_config({"type": index_type}),
+                                      query_texts, query_vectors, k, batch_size)
+            results["runs"].append(dict(size=size, requested_type=index_type, **numbers))
+            print(f"  {numbers['query_latency_ms']} {numbers['batched_qps']} q/s recall@{k}={numbers[f'recall@{k}']}")
+            for name, filtered in numbers["filtered"].items():
+                print(f"  {name} filter: {filtered['query_latency_ms']} recall@{k}={filtered[f'recall@{k}']}")
+            print(f"  hybrid: {numbers['hybrid_query_latency_ms']}")
+            if not keep:
+                shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark index types on synthetic fashion-catalog corpora")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES))
+    parser.add_argument("--index-types", nargs="+", choices=INDEX_TYPES, default=list(INDEX_TYPES))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--encoder", choices=("hashing", "model"), default="hashing",
+                        help="'hashing' runs offline in seconds, 'model' embeds with the app's MiniLM encoder")
+    parser.add_argument("--workdir", default="benchmark_data", help="corpora and indexes are built here")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--keep", action="store_true", help="keep the built indexes")
+    args = parser.parse_args()
+
+    encoder, encoder_id = None, "hashing"
+    if args.encoder == "model":
+        from encoders import load_encoder
+        from vector_store import ENCODER_BACKEND, ENCODER_ID, MODEL_NAME
+
+        encoder, encoder_id = load_encoder(MODEL_NAME, ENCODER_BACKEND), ENCODER_ID
+
+    results = run(args.sizes, args.index_types, args.workdir, args.queries, args.k, encoder, encoder_id,
+                  keep=args.keep)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"✅ Benchmark results saved: {args.output}")
@@ -0,0 +1,37 @@
+import numpy as np
+
+# 1.0 ranks by relevance only, lower values trade relevance for diversity
+MMR_LAMBDA = 0.7
+
+
+def mmr(relevance, vectors, k, lambda_=MMR_LAMBDA):
+    """Pick ``k`` candidates by maximal marginal relevance, return their positions.
+
+    Each step takes the candidate with the best ``lambda_ * relevance -
+    (1 - lambda_) * (highest cosine similarity to the candidates already
+    picked)``, so a near-duplicate of an earlier pick loses to a less
+    relevant chunk that adds something new. ``relevance`` should lie in
+    [0, 1] like the similarities. The pairwise similarities are one matrix
+    product and each step is a vector update, so a few dozen candidates
+    take microseconds.
+    """
+    relevance = np.asarray(relevance, dtype=np.float32)
+    k = min(k, len(relevance))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarity = vectors @ vectors.T
+
+    # Highest similarity to any picked candidate, -1 while nothing is picked
+    redundancy = np.full(len(relevance), -1.0, dtype=np.float32)
+    available = np.ones(len(relevance), dtype=bool)
+    picked = np.empty(k, dtype=np.int64)
+    for step in range(k):
+        scores = np.where(available, lambda_ * relevance - (1 - lambda_) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        picked[step] = best
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return picked
@@ -0,0 +1,115 @@
+import atexit
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_query(text):
+    # "Summer  Dresses " and "summer dresses" share one cache entry
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class EmbeddingCache:
+    """Thread-safe LRU cache of query embeddings keyed on normalized text.
+
+    With a ``spill_path`` the entries are loaded from disk at start-up and
+    written back every ``save_every`` new entries and at interpreter exit,
+    so a restarted app does not start cold. ``namespace`` (the encoder
+    name) is stored with the spill file and a file written by a different
+    encoder is ignored.
+    """
+
+    def __init__(self, max_size=2048, spill_path=None, namespace="", save_every=64):
+        self.max_size = max_size
+        self.spill_path = spill_path
+        self.namespace = namespace
+        self.save_every = save_every
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+        if spill_path:
+            self.load()
+            atexit.register(self.save)
+
+    def get_many(self, texts):
+        """Return cached vectors for ``texts`` in order, ``None`` for misses."""
+        keys = [normalize_query(text) for text in texts]
+        found = []
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is None:
+                    self.misses += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                found.append(vector)
+        return found
+
+    def put_many(self, texts, vectors):
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = normalize_query(text)
+                if key not in self._entries:
+                    self._unsaved += 1
+                self._entries[key] = np.asarray(vector, dtype=np.float32)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+            should_save = self.spill_path and self._unsaved >= self.save_every
+        if should_save:
+            self.save()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def save(self):
+        if not self.spill_path:
+            return
+        with self._lock:
+            if not self._entries:
+                return
+            keys = np.array(list(self._entries.keys()))
+            vectors = np.stack(list(self._entries.values()))
+            self._unsaved = 0
+
+        with self._save_lock:
+            os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+            # Per-process temp name, several app workers may share one spill file
+            tmp_path = f"{self.spill_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, keys=keys, vectors=vectors, namespace=np.array(self.namespace))
+            os.replace(tmp_path, self.spill_path)
+
+    def load(self):
+        if not os.path.exists(self.spill_path):
+            return
+        try:
+            with np.load(self.spill_path) as data:
+                if str(data["namespace"]) != self.namespace:
+                    return
+                keys, vectors = data["keys"], data["vectors"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠ Ignoring unreadable query cache {self.spill_path}: {e}")
+            return
+
+        with self._lock:
+            # Most recently used entries were saved last, keep the newest ones
+            for key, vector in list(zip(keys, vectors))[-self.max_size:]:
+                self._entries[str(key)] = vector
@@ -0,0 +1,332 @@
+import itertools
+import json
+import math
+import os
+import re
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from doc_store import atomic_write
+
+# Postings are stored CSR-style: the postings of term t are
+# docs[offsets[t]:offsets[t + 1]] with their term frequencies in tfs, so
+# the index is a handful of flat arrays that load with mmap_mode="r".
+TERMS_FILE = "lexical_terms.json"
+OFFSETS_FILE = "lexical_offsets.npy"
+DOCS_FILE = "lexical_docs.npy"
+TFS_FILE = "lexical_tfs.npy"
+LENGTHS_FILE = "lexical_lengths.npy"
+FILES = (TERMS_FILE, OFFSETS_FILE, DOCS_FILE, TFS_FILE, LENGTHS_FILE)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+
+# Postings a builder holds in memory (12 bytes each) before writing a run
+MAX_BUILD_POSTINGS = 4_000_000
+
+# Hashtags, percentages and hyphenated codes are kept whole ("#streetmodeon",
+# "20%", "kd-101"); everything else splits on non-word characters
+TOKEN_PATTERN = re.compile(r"#\w+|\d+(?:\.\d+)?%|\w+(?:-\w+)*")
+
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        # Also index the parts, so "streetmodeon" finds "#StreetModeOn"
+        # and "blazer" finds "slim-fit-blazer"
+        if token.startswith("#"):
+            tokens.append(token[1:])
+        elif "-" in token:
+            tokens.extend(part for part in token.split("-") if part)
+    return tokens
+
+
+class LexicalIndexBuilder:
+    """Collects postings for documents added in any id order and saves them.
+
+    Postings accumulate in typed arrays (12 bytes per term occurrence in a
+    document) and are written to ``folder`` as a run sorted by term
+    whenever ``max_postings`` have piled up and at every ``checkpoint()``,
+    so memory stays bounded by one run plus the vocabulary however large
+    the catalog. ``save()`` merges the runs into the CSR arrays
+    ``LexicalIndex`` maps. Like ``doc_store.DocumentStoreWriter``, pass a
+    dict from ``checkpoint()`` as ``state`` to continue an interrupted
+    build: runs written after that checkpoint are dropped.
+    """
+
+    TERMS_PART = "lexical_terms.part"
+    RUN_POSTINGS = "lexical_run_{:05d}.postings.npy"
+    RUN_LENGTHS = "lexical_run_{:05d}.lengths.npy"
+    POSTING_DTYPE = np.dtype([("term", np.int32), ("doc", np.int32), ("tf", np.int32)])
+    LENGTH_DTYPE = np.dtype([("doc", np.int32), ("length", np.int32)])
+
+    def __init__(self, folder, state=None, max_postings=MAX_BUILD_POSTINGS):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_postings = max_postings
+        self.count = state["count"] if state else 0
+        self.size = state["size"] if state else 0
+        self.runs = state["runs"] if state else 0
+
+        # Terms are appended to a text file in id order as runs are written
+        self.vocabulary = {}
+        self._terms_file = open(os.path.join(folder, self.TERMS_PART), "r+b" if state else "wb")
+        if state:
+            self._terms_file.truncate(state["terms_bytes"])
+            for term in self._terms_file.read().decode("utf-8").splitlines():
+                self.vocabulary[term] = len(self.vocabulary)
+        self._saved_terms = len(self.vocabulary)
+
+        number = self.runs
+        while os.path.exists(self._run_path(self.RUN_LENGTHS, number)):
+            for name in (self.RUN_POSTINGS, self.RUN_LENGTHS):
+                if os.path.exists(self._run_path(name, number)):
+                    os.remove(self._run_path(name, number))
+            number += 1
+        self._reset()
+
+    def _run_path(self, name, number):
+        return os.path.join(self.folder, name.format(number))
+
+    def _reset(self):
+        self._terms = array("i")
+        self._docs = array("i")
+        self._tfs = array("i")
+        self._length_docs = array("i")
+        self._lengths = array("i")
+
+    def add(self, doc_id, text):
+        counts = Counter(tokenize(text))
+        self._length_docs.append(doc_id)
+        self._lengths.append(sum(counts.values()))
+        self.size = max(self.size, doc_id + 1)
+        self.count += 1
+        for term, tf in counts.items():
+            self._terms.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+            self._docs.append(doc_id)
+            self._tfs.append(tf)
+        if len(self._docs) >= self.max_postings:
+            self._spill()
+
+    def add_index(self, folder, skip_ids=(), skipped_documents=0):
+        """Add the documents of the BM25 index in ``folder`` except ``skip_ids``, without re-tokenizing.
+
+        Its postings are copied over in runs of ``max_postings``.
+        ``skipped_documents`` is how many of ``skip_ids`` were documents
+        of that index, so the document count stays exact.
+        """
+        self._spill()
+        index = LexicalIndex(folder)
+        skip = np.asarray(sorted(skip_ids), dtype=np.int32)
+        term_ids = np.array([self.vocabulary.setdefault(term, len(self.vocabulary)) for term in index.vocabulary],
+                            dtype=np.int32)
+        for start in range(0, len(index.docs), self.max_postings):
+            end = min(start + self.max_postings, len(index.docs))
+            positions = np.arange(start, end)
+            self._terms = term_ids[np.searchsorted(index.offsets, positions, side="right") - 1]
+            self._docs = np.asarray(index.docs[start:end], dtype=np.int32)
+            self._tfs = np.asarray(index.tfs[start:end], dtype=np.int32)
+            keep = ~np.isin(self._docs, skip)
+            self._terms, self._docs, self._tfs = self._terms[keep], self._docs[keep], self._tfs[keep]
+            self._length_docs = np.zeros(0, dtype=np.int32)
+            self._lengths = np.zeros(0, dtype=np.int32)
+            self._spill(force=True)
+        for start in range(0, len(index.lengths), self.max_postings):
+            doc_ids = np.arange(start, min(start + self.max_postings, len(index.lengths)), dtype=np.int32)
+            keep = ~np.isin(doc_ids, skip)
+            self._length_docs = doc_ids[keep]
+            self._lengths = np.asarray(index.lengths[start:start + len(doc_ids)], dtype=np.int32)[keep]
+            self._spill(force=True)
+        self.size = max(self.size, len(index.lengths))
+        self.count += index.doc_count - skipped_documents
+
+    def _spill(self, force=False):
+        if not force and not len(self._length_docs):
+            return
+        postings = np.empty(len(self._terms), dtype=self.POSTING_DTYPE)
+        postings["term"] = np.asarray(self._terms, dtype=np.int32)
+        postings["doc"] = np.asarray(self._docs, dtype=np.int32)
+        postings["tf"] = np.asarray(self._tfs, dtype=np.int32)
+        # Stable, so postings of a term stay in the order they were added
+        postings = postings[np.argsort(postings["term"], kind="stable")]
+        lengths = np.empty(len(self._lengths), dtype=self.LENGTH_DTYPE)
+        lengths["doc"] = np.asarray(self._length_docs, dtype=np.int32)
+        lengths["length"] = np.asarray(self._lengths, dtype=np.int32)
+
+        # Postings first: a run only counts once its lengths file exists
+        atomic_write(self._run_path(self.RUN_POSTINGS, self.runs), lambda f: np.save(f, postings))
+        atomic_write(self._run_path(self.RUN_LENGTHS, self.runs), lambda f: np.save(f, lengths))
+        self.runs += 1
+        new_terms = list(itertools.islice(self.vocabulary, self._saved_terms, None))
+        if new_terms:
+            self._terms_file.write(("\n".join(new_terms) + "\n").encode("utf-8"))
+        self._saved_terms = len(self.vocabulary)
+        self._reset()
+
+    def checkpoint(self):
+        self._spill()
+        self._terms_file.flush()
+        os.fsync(self._terms_file.fileno())
+        return {"count": self.count, "size": self.size, "runs": self.runs, "terms_bytes": self._terms_file.tell()}
+
+    def save(self):
+        """Merge the runs into the index files in ``folder``, one run in memory at a time."""
+        self._spill()
+        self._terms_file.close()
+        vocabulary_size = len(self.vocabulary)
+
+        counts = np.zeros(vocabulary_size, dtype=np.int64)
+        for number in range(self.runs):
+            terms = np.load(self._run_path(self.RUN_POSTINGS, number), mmap_mode="r")["term"]
+            counts += np.bincount(terms, minlength=vocabulary_size)
+        offsets = np.zeros(vocabulary_size + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        outputs = {
+            DOCS_FILE: (np.int32, offsets[-1]),
+            TFS_FILE: (np.uint16, offsets[-1]),
+            LENGTHS_FILE: (np.int32, self.size),
+        }
+        arrays = {name: np.lib.format.open_memmap(os.path.join(self.folder, name + ".tmp"), mode="w+",
+                                                  dtype=dtype, shape=(size,))
+                  for name, (dtype, size) in outputs.items()}
+        # Runs are in document order, so appending each run's postings
+        # behind the previous ones keeps every term's postings in order
+        filled = offsets[:-1].copy()
+        for number in range(self.runs):
+            postings = np.load(self._run_path(self.RUN_POSTINGS, number))
+            terms = postings["term"]
+            targets = filled[terms] + np.arange(len(terms)) - np.searchsorted(terms, terms)
+            arrays[DOCS_FILE][targets] = postings["doc"]
+            arrays[TFS_FILE][targets] = np.minimum(postings["tf"], np.iinfo(np.uint16).max)
+            filled += np.bincount(terms, minlength=vocabulary_size)
+            lengths = np.load(self._run_path(self.RUN_LENGTHS, number))
+            arrays[LENGTHS_FILE][lengths["doc"]] = lengths["length"]
+        total_length = float(arrays[LENGTHS_FILE].sum())
+        for out in arrays.values():
+            out.flush()
+        del out, arrays
+        for name in outputs:
+            os.replace(os.path.join(self.folder, name + ".tmp"), os.path.join(self.folder, name))
+
+        # Terms whose documents were all dropped by ``add_index`` go
+        live = counts > 0
+        header = {
+            "terms": list(itertools.compress(self.vocabulary, live)),
+            "doc_count": self.count,
+            "avg_length": total_length / max(self.count, 1),
+        }
+        offsets = np.concatenate(([0], offsets[1:][live]))
+        atomic_write(os.path.join(self.folder, OFFSETS_FILE), lambda f: np.save(f, offsets))
+        atomic_write(os.path.join(self.folder, TERMS_FILE), lambda f: f.write(json.dumps(header).encode("utf-8")))
+        for number in range(self.runs):
+            os.remove(self._run_path(self.RUN_POSTINGS, number))
+            os.remove(self._run_path(self.RUN_LENGTHS, number))
+        os.remove(os.path.join(self.folder, self.TERMS_PART))
+
+
+def patch_lexical_index(folder, changes, replaced_documents):
+    """Rewrite the BM25 index in ``folder`` with ``changes`` applied.
+
+    ``changes`` maps document ids to chunk dicts, or ``None`` for removed
+    ones; ``replaced_documents`` is how many of those ids were documents
+    before. Postings of the other documents are carried over as they are,
+    so only the changed chunks are tokenized.
+    """
+    builder = LexicalIndexBuilder(folder)
+    builder.add_index(folder, changes, replaced_documents)
+    for doc_id, document in sorted(changes.items()):
+        if document is not None:
+            builder.add(doc_id, document["text"])
+    builder.save()
+
+
+def corpus_stats(folder):
+    """Document count, total length and per-term document frequencies of one BM25 index.
+
+    Summed over the shards of a corpus they give the global statistics
+    ``LexicalIndex.search`` can score with, see ``shards.write_lexical_stats``.
+    """
+    with open(os.path.join(folder, TERMS_FILE), "r", encoding="utf-8") as f:
+        header = json.load(f)
+    offsets = np.load(os.path.join(folder, OFFSETS_FILE), mmap_mode="r")
+    return {
+        "doc_count": header["doc_count"],
+        "total_length": header["avg_length"] * header["doc_count"],
+        "df": dict(zip(header["terms"], np.diff(offsets).tolist())),
+    }
+
+
+class LexicalIndex:
+    """Read-only BM25 index over the chunks of a vector index folder."""
+
+    def __init__(self, folder):
+        with open(os.path.join(folder, TERMS_FILE), "r", encoding="utf-8") as f:
+            header = json.load(f)
+        self.vocabulary = {term: term_id for term_id, term in enumerate(header["terms"])}
+        self.doc_count = header["doc_count"]
+        self.avg_length = header["avg_length"] or 1.0
+        self.offsets = np.load(os.path.join(folder, OFFSETS_FILE), mmap_mode="r")
+        self.docs = np.load(os.path.join(folder, DOCS_FILE), mmap_mode="r")
+        self.tfs = np.load(os.path.join(folder, TFS_FILE), mmap_mode="r")
+        self.lengths = np.load(os.path.join(folder, LENGTHS_FILE), mmap_mode="r")
+
+    def search(self, query, k, accept=None, stats=None):
+        """Return ``(ids, scores)`` of the ``k`` best BM25 matches, best first.
+
+        ``accept`` optionally maps an array of document ids to a boolean
+        array; postings it rejects are dropped before scoring. ``stats``
+        (``{"doc_count", "avg_length", "df": {term: count}}``) replaces this
+        index's own IDF and length statistics, so shards of one corpus
+        score on the same scale.
+        """
+        doc_count, avg_length = (stats["doc_count"], stats["avg_length"] or 1.0) if stats else (
+            self.doc_count, self.avg_length)
+        doc_parts = []
+        score_parts = []
+        for token in set(tokenize(query)):
+            term_id = self.vocabulary.get(token)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = np.asarray(self.docs[start:end])
+            tfs = np.asarray(self.tfs[start:end], dtype=np.float32)
+            df = stats["df"].get(token, len(docs)) if stats else len(docs)
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            if accept is not None:
+                keep = accept(docs)
+                docs, tfs = docs[keep], tfs[keep]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[docs] / avg_length)
+            doc_parts.append(docs)
+            score_parts.append(idf * tfs * (BM25_K1 + 1) / (tfs + norm))
+
+        if not doc_parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        ids, inverse = np.unique(np.concatenate(doc_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+        if len(ids) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            ids, scores = ids[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return ids[order].astype(np.int64), scores[order].astype(np.float32)
+
+    def search_many(self, queries, k, accept=None, stats=None):
+        return [self.search(query, k, accept, stats) for query in queries]
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=RRF_K):
+    """Fuse ranked id lists into the top ``k`` ``(id, score)`` pairs.
+
+    Each list contributes ``1 / (rrf_k + rank)`` per id, so an id ranked
+    well by both retrievers beats one ranked first by only one of them.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
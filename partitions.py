@@ -0,0 +1,428 @@
+import json
+import math
+import os
+
+import faiss
+import numpy as np
+
+from doc_store import atomic_write, copy_raw_to_npy
+from index_factory import build_params, create_index, min_training_points, supports_remove, train_index
+
+# One partition per category (source file): the full-precision vectors of
+# its chunks and their ids, side by side in two .npy files. Partitions of
+# at least INDEX_MIN_VECTORS vectors also get a FAISS sub-index of the
+# configured type; smaller ones, and every partition of a flat index, are
+# searched exactly. Filtered searches only touch the partitions and ids they
+# ask for, so their cost follows the matching chunks instead of the corpus.
+PARTITIONS_FOLDER = "partitions"
+PARTITIONS_FILE = "partitions.json"
+INDEX_MIN_VECTORS = 20_000
+# A filtered sub-index search multiplies nprobe/efSearch by (partition size /
+# allowed ids) ** FILTER_WIDENING: the nearest allowed vectors lie farther
+# out than the nearest of all, more so the more the filter rules out
+FILTER_WIDENING = 3
+
+
+def partitions_exist(folder):
+    return os.path.exists(os.path.join(folder, PARTITIONS_FOLDER, PARTITIONS_FILE))
+
+
+def _vectors_file(category):
+    return f"{category}.vectors.npy"
+
+
+def _ids_file(category):
+    return f"{category}.ids.npy"
+
+
+def _index_file(category):
+    return f"{category}.faiss"
+
+
+def _read_header(folder):
+    with open(os.path.join(folder, PARTITIONS_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_header(folder, dimension, counts, index=None, indexed=()):
+    # ``index`` is the config the sub-indexes of the ``indexed`` categories were built with
+    header = {"dimension": dimension, "counts": counts, "index": index, "indexed": sorted(indexed)}
+    atomic_write(os.path.join(folder, PARTITIONS_FILE), lambda f: f.write(json.dumps(header).encode("utf-8")))
+
+
+def _remove_stale(folder, categories, indexed=()):
+    keep = {name(category) for category in categories for name in (_vectors_file, _ids_file)}
+    keep |= {_index_file(category) for category in indexed}
+    for filename in os.listdir(folder):
+        if filename.endswith((".npy", ".faiss")) and filename not in keep:
+            os.remove(os.path.join(folder, filename))
+
+
+def _wants_index(config, count):
+    return config["type"] != "flat" and count >= max(INDEX_MIN_VECTORS, min_training_points(config))
+
+
+def _write_sub_index(folder, category, index):
+    # Replace, never rewrite: the file may be a hard link into the published version
+    path = os.path.join(folder, _index_file(category))
+    faiss.write_index(index, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def _build_sub_index(folder, category, config, block=65536):
+    # Rows are added in partition order, so an HNSW node number is its row
+    ids = np.load(os.path.join(folder, _ids_file(category)), mmap_mode="r")
+    vectors = np.load(os.path.join(folder, _vectors_file(category)), mmap_mode="r")
+    index = create_index(config, vectors.shape[1])
+    if not index.is_trained:
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(len(ids), min(len(ids), config["train_size"]), replace=False))
+        train_index(index, vectors[sample], config)
+    for start in range(0, len(ids), block):
+        index.add_with_ids(np.asarray(vectors[start:start + block]), np.asarray(ids[start:start + block]))
+    _write_sub_index(folder, category, index)
+
+
+def build_partition_indexes(folder, config, categories=None):
+    """(Re)build the sub-indexes of the partitions in ``folder`` for ``config``.
+
+    Only ``categories`` are rebuilt if given; partitions below
+    ``INDEX_MIN_VECTORS``, or of a flat config, lose their sub-index.
+    """
+    folder = os.path.join(folder, PARTITIONS_FOLDER)
+    header = _read_header(folder)
+    indexed = set(header.get("indexed", ()))
+    for category, count in header["counts"].items():
+        if categories is not None and category not in categories:
+            continue
+        if _wants_index(config, count):
+            print(f"Building the {config['type']} sub-index of partition {category} ({count} vectors)...")
+            _build_sub_index(folder, category, config)
+            indexed.add(category)
+        else:
+            indexed.discard(category)
+    _remove_stale(folder, header["counts"], indexed)
+    _write_header(folder, header["dimension"], header["counts"], config, indexed)
+
+
+class PartitionUpdate:
+    """Collects changes for an incremental rebuild; ``save()`` merges them in.
+
+    ``add()`` matches ``PartitionWriter.add``, so ``ingest.add_to_partitions``
+    feeds either one. ``remove()`` drops ids from a category. Only the
+    partitions with changes are rewritten, each streamed in blocks; the
+    others keep their files. Their sub-indexes take the same changes, or
+    are rebuilt where that is not possible (HNSW cannot remove vectors).
+    """
+
+    def __init__(self):
+        self.added = {}
+        self.removed = {}
+
+    def add(self, category, ids, vectors):
+        self.added.setdefault(category, []).append((np.asarray(ids, dtype=np.int64), vectors))
+
+    def remove(self, category, ids):
+        self.removed.setdefault(category, []).extend(int(i) for i in ids)
+
+    def save(self, folder, dimension, config, block=65536):
+        """Rewrite the changed partitions of ``folder``: kept rows, then the added vectors.
+
+        ``config`` is the index config the sub-indexes should have; if it
+        changed, every partition large enough gets a new one.
+        """
+        current = Partitions(folder)
+        rebuild_all = current.config is None or build_params(current.config) != build_params(config)
+        if not self.added and not self.removed and not rebuild_all:
+            return
+        folder = current.folder
+        counts = dict(current.counts)
+        indexed = set() if rebuild_all else set(current.indexed)
+        rebuild = set(counts) if rebuild_all else set()
+        for category in set(self.added) | set(self.removed):
+            old_ids, old_vectors = current.get(category) if category in counts else (
+                np.zeros(0, dtype=np.int64), np.zeros((0, dimension), dtype=np.float32))
+            keep = ~np.isin(old_ids, np.asarray(self.removed.get(category, []), dtype=np.int64))
+            added = self.added.get(category, [])
+            count = int(keep.sum()) + sum(len(ids) for ids, _ in added)
+            if count == 0:
+                counts.pop(category, None)
+                indexed.discard(category)
+                rebuild.discard(category)
+                continue
+
+            ids_path = os.path.join(folder, _ids_file(category))
+            vectors_path = os.path.join(folder, _vectors_file(category))
+            out_ids = np.lib.format.open_memmap(ids_path + ".tmp", mode="w+", dtype=np.int64, shape=(count,))
+            out_vectors = np.lib.format.open_memmap(vectors_path + ".tmp", mode="w+", dtype=np.float32,
+                                                    shape=(count, dimension))
+            position = 0
+            for start in range(0, len(old_ids), block):
+                rows = np.flatnonzero(keep[start:start + block]) + start
+                out_ids[position:position + len(rows)] = old_ids[rows]
+                out_vectors[position:position + len(rows)] = old_vectors[rows]
+                position += len(rows)
+            for ids, vectors in added:
+                out_ids[position:position + len(ids)] = ids
+                out_vectors[position:position + len(ids)] = vectors
+                position += len(ids)
+            out_ids.flush()
+            out_vectors.flush()
+            del out_ids, out_vectors
+            os.replace(ids_path + ".tmp", ids_path)
+            os.replace(vectors_path + ".tmp", vectors_path)
+            counts[category] = count
+
+            if category in indexed and _wants_index(config, count) and (supports_remove(config) or keep.all()):
+                # Same order as the rows above, so HNSW node numbers stay partition rows
+                index = faiss.read_index(os.path.join(folder, _index_file(category)))
+                if not keep.all():
+                    index.remove_ids(np.asarray(old_ids[~keep]))
+                for ids, vectors in added:
+                    index.add_with_ids(np.asarray(vectors, dtype=np.float32), ids)
+                _write_sub_index(folder, category, index)
+            else:
+                rebuild.add(category)
+
+        for category in rebuild:
+            if _wants_index(config, counts[category]):
+                _build_sub_index(folder, category, config, block)
+                indexed.add(category)
+            else:
+                indexed.discard(category)
+        _remove_stale(folder, counts, indexed)
+        _write_header(folder, dimension, counts, config, indexed)
+
+
+class PartitionWriter:
+    """Appends vectors to per-category raw files while an index is streamed.
+
+    Works like ``doc_store.DocumentStoreWriter``: ``checkpoint()`` returns
+    the state to resume from and ``close()`` converts the raw files into
+    the ``.npy`` files ``Partitions`` maps.
+    """
+
+    def __init__(self, folder, state=None):
+        self.folder = os.path.join(folder, PARTITIONS_FOLDER)
+        os.makedirs(self.folder, exist_ok=True)
+        self.dimension = state["dimension"] if state else None
+        self.counts = dict(state["counts"]) if state else {}
+        self._files = {}
+
+    def _open(self, category):
+        files = []
+        for suffix, row_size in ((".vectors.part", self.dimension * 4), (".ids.part", 8)):
+            path = os.path.join(self.folder, category + suffix)
+            size = self.counts.get(category, 0) * row_size
+            f = open(path, "r+b" if size else "wb")
+            f.truncate(size)
+            f.seek(size)
+            files.append(f)
+        self._files[category] = files
+        self.counts.setdefault(category, 0)
+        return files
+
+    def add(self, category, ids, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.dimension = self.dimension or vectors.shape[1]
+        vectors_file, ids_file = self._files.get(category) or self._open(category)
+        vectors_file.write(vectors.tobytes())
+        ids_file.write(np.asarray(ids, dtype=np.int64).tobytes())
+        self.counts[category] += len(ids)
+
+    def checkpoint(self):
+        for files in self._files.values():
+            for f in files:
+                f.flush()
+                os.fsync(f.fileno())
+        return {"dimension": self.dimension, "counts": dict(self.counts)}
+
+    def close(self):
+        for category in self.counts:
+            files = self._files.get(category) or self._open(category)
+            for f in files:
+                f.close()
+            vectors_part = os.path.join(self.folder, category + ".vectors.part")
+            ids_part = os.path.join(self.folder, category + ".ids.part")
+            copy_raw_to_npy(vectors_part, os.path.join(self.folder, _vectors_file(category)), np.float32,
+                            self.counts[category], row_shape=(self.dimension,))
+            copy_raw_to_npy(ids_part, os.path.join(self.folder, _ids_file(category)), np.int64, self.counts[category])
+            os.remove(vectors_part)
+            os.remove(ids_part)
+        _write_header(self.folder, self.dimension or 0, self.counts)
+
+
+class Partitions:
+    """Memory-mapped per-category partitions and their sub-indexes.
+
+    ``search_config`` supplies the query-time knobs (``nprobe``,
+    ``ef_search``) of the sub-indexes, by default those they were built with.
+    """
+
+    def __init__(self, folder, search_config=None):
+        self.folder = os.path.join(folder, PARTITIONS_FOLDER)
+        header = _read_header(self.folder)
+        self.dimension = header["dimension"]
+        self.counts = header["counts"]
+        self.config = header.get("index")
+        self.indexed = set(header.get("indexed", ()))
+        self.search_config = dict(self.config or {}, **(search_config or {}))
+        self._mapped = {}
+        self._indexes = {}
+        self._orders = {}
+        self._norms = {}
+
+    @property
+    def categories(self):
+        return list(self.counts)
+
+    def get(self, category):
+        """Return ``(ids, vectors)`` of one partition."""
+        if category not in self._mapped:
+            self._mapped[category] = (
+                np.load(os.path.join(self.folder, _ids_file(category)), mmap_mode="r"),
+                np.load(os.path.join(self.folder, _vectors_file(category)), mmap_mode="r"),
+            )
+        return self._mapped[category]
+
+    def _index(self, category):
+        # The HNSW graph is searched directly, the outer IndexIDMap2 keeps it alive
+        if category not in self._indexes:
+            index = faiss.read_index(os.path.join(self.folder, _index_file(category)))
+            inner = faiss.downcast_index(index.index) if self.config["type"] == "hnsw" else index
+            self._indexes[category] = (index, inner)
+        return self._indexes[category][1]
+
+    def norms(self, category, block=65536):
+        """Squared norms of a partition's vectors, computed on first use."""
+        if category not in self._norms:
+            vectors = self.get(category)[1]
+            norms = np.zeros(len(vectors), dtype=np.float32)
+            for start in range(0, len(vectors), block):
+                rows = np.asarray(vectors[start:start + block])
+                norms[start:start + len(rows)] = np.einsum("ij,ij->i", rows, rows)
+            self._norms[category] = norms
+        return self._norms[category]
+
+    def rows(self, category, ids):
+        """Partition rows of ``ids``, which must all belong to ``category``."""
+        if category not in self._orders:
+            partition_ids = np.asarray(self.get(category)[0])
+            order = np.argsort(partition_ids, kind="stable")
+            self._orders[category] = (order, partition_ids[order])
+        order, sorted_ids = self._orders[category]
+        return order[np.searchsorted(sorted_ids, ids)]
+
+    def search(self, query_vectors, k, subsets=None, rerank=1, exact=False):
+        """L2 search over some partitions, shaped like ``faiss.Index.search``.
+
+        ``subsets`` maps the categories to search (all by default) to the
+        sorted ids allowed in each, or to ``None`` for the whole partition.
+        Partitions with a sub-index search it unless ``exact`` is set or
+        scoring the allowed ids exactly is cheaper; the filter is passed to
+        FAISS as a selector, so only allowed ids are ever scored. IVF-PQ
+        sub-indexes fetch ``k * rerank`` candidates and re-rank them on the
+        stored vectors. Missing results are padded with id -1.
+        """
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        if subsets is None:
+            subsets = dict.fromkeys(self.counts)
+        found_ids = []
+        found_distances = []
+        for category in sorted(set(subsets) & set(self.counts)):
+            ids = subsets[category]
+            if ids is not None and not len(ids):
+                continue
+            effort = None if exact or category not in self.indexed else self._effort(category, ids)
+            if effort is None:
+                rows = None if ids is None else np.sort(self.rows(category, ids))
+                found = self._search_exact(queries, k, category, rows)
+            else:
+                found = self._search_index(queries, k, category, ids, rerank, effort)
+            for distances, result_ids in found:
+                found_distances.append(distances)
+                found_ids.append(result_ids)
+
+        result_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        result_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        if found_ids:
+            ids = np.concatenate(found_ids, axis=1)
+            distances = np.concatenate(found_distances, axis=1)
+            order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+            result_ids[:, :order.shape[1]] = np.take_along_axis(ids, order, axis=1)
+            result_distances[:, :order.shape[1]] = np.take_along_axis(distances, order, axis=1)
+        return result_distances, result_ids
+
+    def _search_exact(self, queries, k, category, rows=None, block=65536):
+        # Top k of every block of rows, merged by search()
+        partition_ids, partition_vectors = self.get(category)
+        partition_norms = self.norms(category)
+        count = len(partition_ids) if rows is None else len(rows)
+        query_norms = (queries ** 2).sum(axis=1)[:, None]
+        for start in range(0, count, block):
+            selected = slice(start, start + block) if rows is None else rows[start:start + block]
+            ids = np.asarray(partition_ids[selected])
+            vectors = np.asarray(partition_vectors[selected])
+            distances = query_norms - 2 * queries @ vectors.T + partition_norms[selected][None, :]
+            if len(ids) > k:
+                top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                yield np.take_along_axis(distances, top, axis=1), ids[top]
+            else:
+                yield distances, np.broadcast_to(ids, distances.shape)
+
+    def _effort(self, category, ids):
+        """``efSearch``/``nprobe`` for searching the sub-index with ``ids``
+        allowed, or ``None`` if scoring those ids exactly is cheaper."""
+        config = self.search_config
+        count = self.counts[category]
+        widen = 1 if ids is None else (count / len(ids)) ** FILTER_WIDENING
+        if config["type"] == "hnsw":
+            # Measured: each unit of efSearch costs about as much as scoring
+            # hnsw_m / 2 scattered rows exactly
+            effort = int(min(count, math.ceil(config["ef_search"] * widen)))
+            visited = effort * config["hnsw_m"] / 2
+        else:
+            effort = int(min(config["nlist"], math.ceil(config["nprobe"] * widen)))
+            visited = count * effort / config["nlist"]
+        return effort if ids is None or visited < len(ids) else None
+
+    def _search_index(self, queries, k, category, ids, rerank, effort):
+        index = self._index(category)
+        kind = self.search_config["type"]
+        fetch = k * rerank if kind == "ivf_pq" else k
+        if kind == "hnsw":
+            selector = None
+            if ids is not None:
+                allowed = np.zeros(self.counts[category], dtype=bool)
+                allowed[self.rows(category, ids)] = True
+                bitmap = np.packbits(allowed, bitorder="little")
+                selector = faiss.IDSelectorBitmap(len(allowed), faiss.swig_ptr(bitmap))
+                # FAISS stops a filtered HNSW search once its k results
+                # settle, whatever efSearch says, so ask for efSearch of them
+                fetch = max(k, effort)
+            params = faiss.SearchParametersHNSW(efSearch=max(fetch, effort), sel=selector)
+            distances, rows = index.search(queries, fetch, params=params)
+            distances, rows = distances[:, :k], rows[:, :k]
+            partition_ids = self.get(category)[0]
+            found = np.where(rows >= 0, np.asarray(partition_ids[np.maximum(rows, 0)]), -1)
+        else:
+            selector = None if ids is None else faiss.IDSelectorBatch(np.asarray(ids, dtype=np.int64))
+            params = faiss.SearchParametersIVF(nprobe=effort, sel=selector)
+            distances, found = index.search(queries, fetch, params=params)
+        if fetch > k and kind == "ivf_pq":
+            yield from self._rerank(queries, k, category, found)
+        else:
+            yield distances, found
+
+    def _rerank(self, queries, k, category, candidates):
+        # Exact L2 of the approximate candidates on the stored vectors
+        partition_ids, partition_vectors = self.get(category)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        found = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, (query, ids) in enumerate(zip(queries, candidates)):
+            ids = np.unique(ids[ids != -1])
+            exact = ((np.asarray(partition_vectors[self.rows(category, ids)]) - query) ** 2).sum(axis=1)
+            order = np.argsort(exact, kind="stable")[:k]
+            distances[row, :len(order)] = exact[order]
+            found[row, :len(order)] = ids[order]
+        yield distances, found
@@ -0,0 +1,113 @@
+import hashlib
+import re
+
+# Lines that open a new section even without a blank line before them,
+# e.g. "Campaign 2: #StreetModeOn", "Segment 1: College Students", "3. Tailored Blazer"
+SECTION_START = re.compile(r"^(?:[A-Z][\w' ]*\s\d+:|\d+\.\s)")
+
+MAX_CHUNK_CHARS = 800
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _is_heading(line):
+    return line.rstrip().endswith(":")
+
+
+def split_sections(text):
+    """Split a knowledge-base file into (offset, section_text) pairs.
+
+    Sections are separated by blank lines, and a line such as
+    "Campaign N:" or a numbered product starts a new section unless it
+    directly follows a heading line like "Popular Products:".
+    """
+    sections = []
+    start = None
+    lines = []
+    offset = 0
+
+    def flush():
+        if lines:
+            sections.append((start, "\n".join(lines).strip()))
+
+    for line in text.splitlines(keepends=True):
+        stripped = line.rstrip("\r\n")
+        if not stripped.strip():
+            flush()
+            lines, start = [], None
+        elif lines and SECTION_START.match(stripped) and not (len(lines) == 1 and _is_heading(lines[0])):
+            flush()
+            lines, start = [stripped], offset
+        else:
+            if start is None:
+                start = offset
+            lines.append(stripped)
+        offset += len(line)
+    flush()
+
+    return sections
+
+
+def _split_by_size(offset, text, max_chars):
+    # Size-based fallback: pack whole lines up to max_chars, hard-cutting
+    # any single line that is longer than that on its own.
+    pieces = []
+    current = ""
+    current_offset = offset
+    position = offset
+
+    for line in text.splitlines(keepends=True):
+        while len(line) > max_chars:
+            if current:
+                pieces.append((current_offset, current.strip()))
+                current = ""
+            pieces.append((position, line[:max_chars].strip()))
+            position += max_chars
+            line = line[max_chars:]
+        if current and len(current) + len(line) > max_chars:
+            pieces.append((current_offset, current.strip()))
+            current = ""
+        if not current:
+            current_offset = position
+        current += line
+        position += len(line)
+
+    if current.strip():
+        pieces.append((current_offset, current.strip()))
+    return [(o, t) for o, t in pieces if t]
+
+
+def chunk_text(text, source_file, max_chars=MAX_CHUNK_CHARS):
+    """Turn one knowledge-base file into a list of chunk dicts.
+
+    Each chunk carries ``source_file``, ``chunk_id`` (its position within
+    the file) and ``offset`` (character offset of the section in the file).
+    A single-line first section such as "Category: Men's Wear" is treated
+    as the file title and prefixed to every other chunk so each one still
+    says what it is about.
+    """
+    sections = split_sections(text)
+
+    title = ""
+    if len(sections) > 1 and "\n" not in sections[0][1]:
+        title = sections[0][1]
+        sections = sections[1:]
+
+    pieces = []
+    for offset, section in sections:
+        if len(section) > max_chars:
+            pieces.extend(_split_by_size(offset, section, max_chars))
+        else:
+            pieces.append((offset, section))
+
+    chunks = []
+    for chunk_id, (offset, piece) in enumerate(pieces):
+        chunks.append({
+            "text": f"{title}\n\n{piece}" if title else piece,
+            "source_file": source_file,
+            "chunk_id": chunk_id,
+            "offset": offset,
+        })
+    return chunks
@@ -0,0 +1,322 @@
+import json
+import os
+
+import numpy as np
+
+from tagging import TAG_BITS, category_of, chunk_tags, describe_tags
+
+# Chunk texts live back to back in one UTF-8 blob; offsets[i]:offsets[i + 1]
+# is the text of document id i. Ids freed by incremental rebuilds stay as
+# empty slots with source -1. tags is the tagging.chunk_tags() mask; the
+# sorted ids of the live chunks carrying tag bit b are
+# tag_ids[tag_offsets[b]:tag_offsets[b + 1]].
+BLOB_FILE = "documents.bin"
+OFFSETS_FILE = "documents_offsets.npy"
+META_FILE = "documents_meta.npy"
+SOURCES_FILE = "documents_sources.json"
+TAG_IDS_FILE = "documents_tag_ids.npy"
+TAG_OFFSETS_FILE = "documents_tag_offsets.npy"
+FILES = (BLOB_FILE, OFFSETS_FILE, META_FILE, SOURCES_FILE, TAG_IDS_FILE, TAG_OFFSETS_FILE)
+
+META_DTYPE = np.dtype([("source", np.int32), ("chunk_id", np.int32), ("offset", np.int64), ("tags", np.uint32)])
+
+
+def document_store_exists(folder):
+    return all(os.path.exists(os.path.join(folder, name)) for name in FILES)
+
+
+def atomic_write(path, write):
+    # Write next to the target and rename over it, so processes that still
+    # have the old file memory-mapped keep reading the old, intact pages
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def patch_document_store(folder, changes, count, block=1 << 20):
+    """Rewrite the store in ``folder`` as ``count`` ids with ``changes`` applied.
+
+    ``changes`` maps document ids to chunk dicts, or ``None`` to free the
+    id. Every other id keeps its current row: texts and metadata are
+    copied over in blocks rather than decoded, so an incremental update
+    costs memory in proportion to the changes, and only changed chunks are
+    tagged. The new files replace the old ones, never rewrite them.
+    """
+    store = DocumentStore(folder)
+    sources = list(store.sources)
+    source_ids = {source: i for i, source in enumerate(sources)}
+    offsets = np.lib.format.open_memmap(os.path.join(folder, OFFSETS_FILE + ".tmp"), mode="w+", dtype=np.int64,
+                                        shape=(count + 1,))
+    meta = np.lib.format.open_memmap(os.path.join(folder, META_FILE + ".tmp"), mode="w+", dtype=META_DTYPE,
+                                     shape=(count,))
+
+    def write_blob(f):
+        position = 0
+        start = 0
+        for doc_id in sorted(changes) + [count]:
+            # Unchanged rows before doc_id: copied as they are, free beyond the old store
+            end = min(doc_id, len(store))
+            for begin in range(start, end, block):
+                stop = min(begin + block, end)
+                first, last = int(store.offsets[begin]), int(store.offsets[stop])
+                for byte in range(first, last, block):
+                    f.write(store.blob[byte:min(byte + block, last)].tobytes())
+                offsets[begin + 1:stop + 1] = np.asarray(store.offsets[begin + 1:stop + 1]) - first + position
+                meta[begin:stop] = store.meta[begin:stop]
+                position += last - first
+            free_start = max(start, end)
+            meta["source"][free_start:doc_id] = -1
+            offsets[free_start + 1:doc_id + 1] = position
+            if doc_id == count:
+                break
+
+            document = changes[doc_id]
+            if document is None:
+                meta[doc_id] = (-1, 0, 0, 0)
+            else:
+                data = document["text"].encode("utf-8")
+                f.write(data)
+                position += len(data)
+                source = document["source_file"]
+                if source not in source_ids:
+                    source_ids[source] = len(sources)
+                    sources.append(source)
+                meta[doc_id] = (source_ids[source], document["chunk_id"], document["offset"],
+                                chunk_tags(document["text"]))
+            offsets[doc_id + 1] = position
+            start = doc_id + 1
+
+    atomic_write(os.path.join(folder, BLOB_FILE), write_blob)
+    offsets.flush()
+    meta.flush()
+    del offsets, meta
+    for name in (OFFSETS_FILE, META_FILE):
+        os.replace(os.path.join(folder, name + ".tmp"), os.path.join(folder, name))
+    atomic_write(os.path.join(folder, SOURCES_FILE), lambda f: f.write(json.dumps(sources).encode("utf-8")))
+    write_tag_ids(folder, block)
+
+
+def write_tag_ids(folder, block=1 << 20):
+    """Write the per-tag id lists of the store in ``folder`` from its metadata.
+
+    Two passes over the tags column in blocks: one counts the ids of every
+    bit, the other fills them in, so memory stays bounded by ``block``.
+    """
+    meta = np.load(os.path.join(folder, META_FILE), mmap_mode="r")
+    bits = [1 << bit for bit in range(len(TAG_BITS))]
+
+    def blocks():
+        for start in range(0, len(meta), block):
+            rows = np.asarray(meta[start:start + block])
+            yield start, np.where(rows["source"] >= 0, rows["tags"], 0)
+
+    counts = np.zeros(len(bits), dtype=np.int64)
+    for _, tags in blocks():
+        counts += [np.count_nonzero(tags & bit) for bit in bits]
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    ids_path = os.path.join(folder, TAG_IDS_FILE)
+    tag_ids = np.lib.format.open_memmap(ids_path + ".tmp", mode="w+", dtype=np.int64, shape=(int(offsets[-1]),))
+    positions = offsets[:-1].copy()
+    for start, tags in blocks():
+        for number, bit in enumerate(bits):
+            rows = np.flatnonzero(tags & bit) + start
+            tag_ids[positions[number]:positions[number] + len(rows)] = rows
+            positions[number] += len(rows)
+    tag_ids.flush()
+    del tag_ids
+    os.replace(ids_path + ".tmp", ids_path)
+    atomic_write(os.path.join(folder, TAG_OFFSETS_FILE), lambda f: np.save(f, offsets))
+
+
+def copy_raw_to_npy(raw_path, npy_path, dtype, count, prefix=None, row_shape=(), block=1 << 20):
+    # Stream a raw array file into an .npy in blocks instead of loading it
+    total = count + (len(prefix) if prefix is not None else 0)
+    tmp_path = npy_path + ".tmp"
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=(total,) + tuple(row_shape))
+    start = 0
+    if prefix is not None:
+        out[:len(prefix)] = prefix
+        start = len(prefix)
+    if count:
+        raw = np.memmap(raw_path, dtype=dtype, mode="r", shape=(count,) + tuple(row_shape))
+        for begin in range(0, count, block):
+            out[start + begin:start + begin + block] = raw[begin:begin + block]
+        del raw
+    out.flush()
+    del out
+    os.replace(tmp_path, npy_path)
+
+
+class DocumentStoreWriter:
+    """Appends documents to the store in ``folder`` one at a time.
+
+    Texts go straight into the blob and offsets/metadata into raw side
+    files, so memory use does not grow with the number of documents.
+    ``close()`` turns the side files into the ``.npy`` arrays that
+    DocumentStore maps. Pass a dict from ``checkpoint()`` as ``state`` to
+    continue an interrupted build: anything written after that checkpoint
+    is truncated away.
+    """
+
+    OFFSETS_PART = "documents_offsets.part"
+    META_PART = "documents_meta.part"
+
+    def __init__(self, folder, state=None):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.count = state["count"] if state else 0
+        self.position = state["blob_size"] if state else 0
+        self.sources = list(state["sources"]) if state else []
+        self._source_ids = {source: i for i, source in enumerate(self.sources)}
+
+        sizes = {
+            BLOB_FILE: self.position,
+            self.OFFSETS_PART: self.count * np.dtype(np.int64).itemsize,
+            self.META_PART: self.count * META_DTYPE.itemsize,
+        }
+        self._files = {}
+        for name, size in sizes.items():
+            f = open(os.path.join(folder, name), "r+b" if state else "wb")
+            f.truncate(size)
+            f.seek(size)
+            self._files[name] = f
+
+    def append(self, document):
+        """Write one chunk dict and return its document id."""
+        data = document["text"].encode("utf-8")
+        self._files[BLOB_FILE].write(data)
+        self.position += len(data)
+        self._files[self.OFFSETS_PART].write(np.int64(self.position).tobytes())
+
+        source = document["source_file"]
+        if source not in self._source_ids:
+            self._source_ids[source] = len(self.sources)
+            self.sources.append(source)
+        meta = np.array(
+            [(self._source_ids[source], document["chunk_id"], document["offset"], chunk_tags(document["text"]))],
+            dtype=META_DTYPE,
+        )
+        self._files[self.META_PART].write(meta.tobytes())
+
+        self.count += 1
+        return self.count - 1
+
+    def checkpoint(self):
+        for f in self._files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        return {"count": self.count, "blob_size": self.position, "sources": list(self.sources)}
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+
+        offsets_part = os.path.join(self.folder, self.OFFSETS_PART)
+        meta_part = os.path.join(self.folder, self.META_PART)
+        copy_raw_to_npy(offsets_part, os.path.join(self.folder, OFFSETS_FILE), np.int64, self.count,
+                         prefix=np.zeros(1, dtype=np.int64))
+        copy_raw_to_npy(meta_part, os.path.join(self.folder, META_FILE), META_DTYPE, self.count)
+        atomic_write(os.path.join(self.folder, SOURCES_FILE), lambda f: f.write(json.dumps(self.sources).encode("utf-8")))
+        write_tag_ids(self.folder)
+        os.remove(offsets_part)
+        os.remove(meta_part)
+
+
+class DocumentStore:
+    """Read-only, memory-mapped view of the chunk texts and their metadata.
+
+    Nothing is decoded up front: ``store[doc_id]`` slices the blob and builds
+    the chunk dict on demand, and the mapped pages are shared between
+    processes through the OS page cache.
+    """
+
+    def __init__(self, folder):
+        self.offsets = np.load(os.path.join(folder, OFFSETS_FILE), mmap_mode="r")
+        self.meta = np.load(os.path.join(folder, META_FILE), mmap_mode="r")
+        self.tag_ids = np.load(os.path.join(folder, TAG_IDS_FILE), mmap_mode="r")
+        self.tag_offsets = np.load(os.path.join(folder, TAG_OFFSETS_FILE))
+        with open(os.path.join(folder, SOURCES_FILE), "r", encoding="utf-8") as f:
+            self.sources = json.load(f)
+
+        blob_path = os.path.join(folder, BLOB_FILE)
+        if os.path.getsize(blob_path):
+            self.blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.meta)
+
+    def __getitem__(self, doc_id):
+        source, chunk_id, offset, tags = self.meta[doc_id]
+        if source < 0:
+            return None
+        return {
+            "text": self.text(doc_id),
+            "source_file": self.sources[source],
+            "chunk_id": int(chunk_id),
+            "offset": int(offset),
+            "category": category_of(self.sources[source]),
+            "tags": describe_tags(int(tags)),
+        }
+
+    def __iter__(self):
+        for doc_id in range(len(self)):
+            yield self[doc_id]
+
+    def matches(self, ids, tag_masks, source_ids=None):
+        """Boolean array: which of ``ids`` are live, carry a tag from every mask
+        and, if ``source_ids`` is given, come from one of those sources."""
+        meta = self.meta[ids]
+        keep = meta["source"] >= 0
+        for mask in tag_masks:
+            keep &= (meta["tags"] & mask) != 0
+        if source_ids is not None:
+            keep &= np.isin(meta["source"], source_ids)
+        return keep
+
+    def tagged(self, tag_masks):
+        """Sorted ids of the live chunks that carry a tag from every mask.
+
+        Read from the per-tag id lists, so the cost follows the number of
+        tagged chunks rather than the corpus.
+        """
+        result = None
+        for mask in tag_masks:
+            lists = [self.tag_ids[self.tag_offsets[bit]:self.tag_offsets[bit + 1]]
+                     for bit in range(len(self.tag_offsets) - 1) if mask & (1 << bit)]
+            ids = np.asarray(lists[0]) if len(lists) == 1 else np.unique(np.concatenate(lists))
+            result = ids if result is None else np.intersect1d(result, ids, assume_unique=True)
+        return result
+
+    def by_category(self, ids, categories=None):
+        """Split sorted ``ids`` into ``{category: sorted ids}``, keeping only
+        ``categories`` if given."""
+        source_categories = [category_of(source) for source in self.sources]
+        names = sorted(set(source_categories))
+        codes = np.array([names.index(category) for category in source_categories], dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        ids_codes = codes[self.meta["source"][ids]]
+        order = np.argsort(ids_codes, kind="stable")
+        bounds = np.searchsorted(ids_codes[order], np.arange(len(names) + 1))
+        return {name: ids[order[bounds[code]:bounds[code + 1]]] for code, name in enumerate(names)
+                if categories is None or name in categories}
+
+    def acceptor(self, categories=None, tag_masks=()):
+        """``accept(ids)`` for a parsed filter, see ``matches``.
+
+        Only the metadata of the ids passed in is read, so filtering the
+        postings a query touches costs in proportion to them, not to the
+        corpus.
+        """
+        source_ids = None
+        if categories is not None:
+            source_ids = np.array([i for i, source in enumerate(self.sources) if category_of(source) in categories],
+                                  dtype=np.int32)
+        return lambda ids: self.matches(ids, tag_masks, source_ids)
+
+    def text(self, doc_id):
+        start, end = self.offsets[doc_id], self.offsets[doc_id + 1]
+        return self.blob[start:end].tobytes().decode("utf-8")
@@ -0,0 +1,121 @@
+import json
+import os
+
+import numpy as np
+
+from doc_store import atomic_write, copy_raw_to_npy
+
+# Row i of embeddings.npy is the vector of document id i (zeros for free
+# ids). embeddings.json names the encoder that produced them, so vectors
+# of another model are never mixed in.
+EMBEDDINGS_FILE = "embeddings.npy"
+EMBEDDINGS_HEADER = "embeddings.json"
+EMBEDDING_DTYPES = ("float32", "float16")
+
+
+def embeddings_exist(folder, model):
+    path = os.path.join(folder, EMBEDDINGS_HEADER)
+    if not os.path.exists(path) or not os.path.exists(os.path.join(folder, EMBEDDINGS_FILE)):
+        return False
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["model"] == model
+
+
+def _write_header(folder, model, dtype, dimension):
+    header = {"model": model, "dtype": dtype, "dimension": dimension}
+    atomic_write(os.path.join(folder, EMBEDDINGS_HEADER), lambda f: f.write(json.dumps(header).encode("utf-8")))
+
+
+def patch_embeddings(folder, count, updates, removed_ids, model, dtype="float32", block=65536):
+    """Rewrite the stored matrix as ``count`` rows with some rows changed.
+
+    Rows of ``removed_ids`` become zeros and each ``(ids, vectors)`` of
+    ``updates`` is written over its rows; the rest is copied from the
+    current file in blocks through a memory map, so an incremental update
+    never holds the whole matrix.
+    """
+    current = EmbeddingStore(folder)
+    dimension = current.dimension
+    tmp_path = os.path.join(folder, EMBEDDINGS_FILE + ".tmp")
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=(count, dimension))
+    kept = min(len(current), count)
+    for start in range(0, kept, block):
+        out[start:min(start + block, kept)] = current.matrix[start:min(start + block, kept)]
+    out[np.asarray(removed_ids, dtype=np.int64)] = 0
+    for ids, vectors in updates:
+        out[np.asarray(ids, dtype=np.int64)] = vectors
+    out.flush()
+    del out, current
+    os.replace(tmp_path, os.path.join(folder, EMBEDDINGS_FILE))
+    _write_header(folder, model, dtype, dimension)
+
+
+class EmbeddingWriter:
+    """Appends vectors in document id order while an index is streamed.
+
+    Same life cycle as ``doc_store.DocumentStoreWriter``: a raw side file
+    that ``checkpoint()``/``state`` can truncate back to, turned into the
+    ``.npy`` by ``close()``.
+    """
+
+    PART = "embeddings.part"
+
+    def __init__(self, folder, model, dtype="float32", state=None):
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unknown embeddings dtype {dtype!r}, expected one of {EMBEDDING_DTYPES}")
+        self.folder = folder
+        self.model = model
+        self.dtype = dtype
+        self.count = state["count"] if state else 0
+        self.dimension = state["dimension"] if state else None
+        size = self.count * (self.dimension or 0) * np.dtype(dtype).itemsize
+        self._file = open(os.path.join(folder, self.PART), "r+b" if state else "wb")
+        self._file.truncate(size)
+        self._file.seek(size)
+
+    def append(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype)
+        self.dimension = self.dimension or vectors.shape[1]
+        self._file.write(vectors.tobytes())
+        self.count += len(vectors)
+
+    def checkpoint(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return {"count": self.count, "dimension": self.dimension}
+
+    def close(self, dimension):
+        self._file.close()
+        part = os.path.join(self.folder, self.PART)
+        self.dimension = self.dimension or dimension
+        copy_raw_to_npy(part, os.path.join(self.folder, EMBEDDINGS_FILE), self.dtype, self.count,
+                        row_shape=(self.dimension,))
+        os.remove(part)
+        _write_header(self.folder, self.model, self.dtype, self.dimension)
+
+
+class EmbeddingStore:
+    """Memory-mapped view of the stored embeddings, returned as float32."""
+
+    def __init__(self, folder):
+        with open(os.path.join(folder, EMBEDDINGS_HEADER), "r", encoding="utf-8") as f:
+            header = json.load(f)
+        self.model = header["model"]
+        self.dtype = header["dtype"]
+        self.matrix = np.load(os.path.join(folder, EMBEDDINGS_FILE), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.matrix)
+
+    @property
+    def dimension(self):
+        return self.matrix.shape[1]
+
+    def vectors(self, ids):
+        return np.asarray(self.matrix[np.asarray(ids, dtype=np.int64)], dtype=np.float32)
+
+    def iter_blocks(self, ids, block=65536):
+        """Yield ``(ids, float32 vectors)`` for ``ids`` in blocks of ``block``."""
+        for start in range(0, len(ids), block):
+            chunk = ids[start:start + block]
+            yield chunk, self.vectors(chunk)
@@ -0,0 +1,215 @@
+import argparse
+import multiprocessing
+import os
+import time
+from collections import deque
+
+import numpy as np
+
+# "torch" is the original full-precision PyTorch model. "onnx" runs the same
+# fp32 weights through ONNX Runtime, "onnx-int8" the dynamically quantized
+# (int8 weights, AVX2 kernels) export that the model repo ships under onnx/.
+ENCODER_BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_INT8_FILE = "onnx/model_quint8_avx2.onnx"
+
+
+def load_encoder(model_name, backend="torch", threads=None):
+    """Return a SentenceTransformer for ``model_name`` on the given backend.
+
+    The ONNX backends need the optional ``sentence-transformers[onnx]``
+    extra (optimum + onnxruntime). ``threads`` caps ONNX Runtime's
+    intra-op pool, which ignores ``OMP_NUM_THREADS``; torch threads are
+    set by the caller.
+    """
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend!r}, expected one of {ENCODER_BACKENDS}")
+
+    from sentence_transformers import SentenceTransformer
+
+    if backend == "torch":
+        return SentenceTransformer(model_name)
+    model_kwargs = {"file_name": ONNX_INT8_FILE} if backend == "onnx-int8" else {}
+    if threads:
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = threads
+        model_kwargs["session_options"] = session_options
+    return SentenceTransformer(model_name, backend="onnx", model_kwargs=model_kwargs or None)
+
+
+# ── Multi-process encoding ────────────────────────────────────────────────────
+
+_worker_encoder = None
+
+
+def _init_worker(model_name, backend, threads):
+    # Runs once per worker: pin the thread count before torch/onnxruntime
+    # start their pools, then load this worker's copy of the model.
+    # ONNX Runtime only honours its own session options, see load_encoder
+    global _worker_encoder
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+    if backend == "torch":
+        import torch
+        torch.set_num_threads(threads)
+    _worker_encoder = load_encoder(model_name, backend, threads)
+
+
+def _encode_in_worker(texts, batch_size):
+    return np.asarray(_worker_encoder.encode(texts, batch_size=batch_size), dtype=np.float32)
+
+
+def _dimension_in_worker():
+    return _worker_encoder.get_sentence_embedding_dimension()
+
+
+class ParallelEncoder:
+    """Fans encoding out over ``workers`` processes, each with its own model.
+
+    ``map_batches`` yields results in input order, so vector ids assigned
+    from the output stay deterministic, and it keeps at most
+    ``2 * workers`` batches in flight to bound memory. ``threads_per_worker``
+    sets the torch or ONNX Runtime threads of each process; workers times threads
+    should not exceed the cores of the build box. Use it as a context
+    manager so the pool is shut down after the build.
+    """
+
+    def __init__(self, model_name, backend="torch", workers=None, threads_per_worker=1, batch_size=32):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        # spawn, not fork: torch's thread pools do not survive a fork
+        context = multiprocessing.get_context("spawn")
+        self._pool = context.Pool(
+            self.workers, initializer=_init_worker, initargs=(model_name, backend, threads_per_worker)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def get_sentence_embedding_dimension(self):
+        return self._pool.apply(_dimension_in_worker)
+
+    def encode(self, texts, batch_size=None):
+        batch_size = batch_size or self.batch_size
+        texts = list(texts)
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        if not batches:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        return np.concatenate([embeddings for _, embeddings in self.map_batches(batches)])
+
+    def map_batches(self, batches, text_of=None):
+        """Yield ``(batch, embeddings)`` for each batch, in input order."""
+        in_flight = deque()
+        for batch in batches:
+            texts = [text_of(item) for item in batch] if text_of else list(batch)
+            in_flight.append((batch, self._pool.apply_async(_encode_in_worker, (texts, self.batch_size))))
+            if len(in_flight) >= 2 * self.workers:
+                done, result = in_flight.popleft()
+                yield done, result.get()
+        while in_flight:
+            done, result = in_flight.popleft()
+            yield done, result.get()
+
+
+def embed_batches(encoder, batches, text_of=lambda chunk: chunk["text"]):
+    """Yield ``(batch, float32 embeddings)`` in order with any encoder."""
+    if isinstance(encoder, ParallelEncoder):
+        yield from encoder.map_batches(batches, text_of)
+        return
+    for batch in batches:
+        yield batch, np.asarray(encoder.encode([text_of(item) for item in batch]), dtype=np.float32)
+
+
+# ── Backend comparison ────────────────────────────────────────────────────────
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def _top_k(corpus, queries, k):
+    # Exact L2 ranking, the same order IndexFlatL2 returns
+    distances = (
+        (queries ** 2).sum(axis=1)[:, None]
+        - 2 * queries @ corpus.T
+        + (corpus ** 2).sum(axis=1)[None, :]
+    )
+    return np.argsort(distances, axis=1)[:, :k]
+
+
+def compare_backends(model_name, documents, queries, backends=ENCODER_BACKENDS, k=5, batch_size=32, repeat=1):
+    """Check each backend against the fp32 PyTorch encoder and time it.
+
+    For every backend this reports the cosine similarity of its document
+    embeddings to the reference ones (mean and worst case), the overlap of
+    its top-``k`` results with the reference top-``k`` for ``queries``,
+    document throughput (over ``documents`` repeated ``repeat`` times, so
+    small corpora still give stable numbers), and single-query latency.
+    """
+    reference = load_encoder(model_name, "torch")
+    reference_docs = np.asarray(reference.encode(documents, batch_size=batch_size), dtype=np.float32)
+    reference_top = _top_k(reference_docs, np.asarray(reference.encode(queries), dtype=np.float32), k)
+
+    report = {}
+    for backend in backends:
+        encoder = reference if backend == "torch" else load_encoder(model_name, backend)
+        encoder.encode(queries[:1])  # first call pays for graph/session setup
+
+        docs = np.asarray(encoder.encode(documents, batch_size=batch_size), dtype=np.float32)
+
+        started = time.perf_counter()
+        encoder.encode(documents * repeat, batch_size=batch_size)
+        encode_seconds = time.perf_counter() - started
+
+        latencies = []
+        query_vectors = []
+        for query in queries:
+            started = time.perf_counter()
+            query_vectors.append(encoder.encode([query])[0])
+            latencies.append(time.perf_counter() - started)
+
+        cosine = (_normalize(docs) * _normalize(reference_docs)).sum(axis=1)
+        top = _top_k(docs, np.asarray(query_vectors, dtype=np.float32), k)
+        overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(top, reference_top)])
+
+        report[backend] = {
+            "cosine_mean": round(float(cosine.mean()), 5),
+            "cosine_min": round(float(cosine.min()), 5),
+            f"overlap@{k}": round(float(overlap), 4),
+            "docs_per_second": round(len(documents) * repeat / encode_seconds, 1),
+            "query_ms_p50": round(float(np.percentile(latencies, 50)) * 1000, 2),
+            "query_ms_p95": round(float(np.percentile(latencies, 95)) * 1000, 2),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    from vector_store import MODEL_NAME, load_all_chunks
+
+    parser = argparse.ArgumentParser(description="Compare encoder backends against fp32 PyTorch on the knowledge base")
+    parser.add_argument("--backends", nargs="+", choices=ENCODER_BACKENDS, default=list(ENCODER_BACKENDS))
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20, help="repeat the corpus to get stable throughput numbers")
+    args = parser.parse_args()
+
+    chunks = [chunk["text"] for chunk in load_all_chunks()]
+    queries = [
+        "Instagram ad for summer women's dresses with 20% discount",
+        "men's formal shoes for office professionals",
+        "youth streetwear campaign with oversized t-shirts and sneakers",
+        "festive collection with statement heels",
+        "student discount on jeans",
+        "brand tone of voice and tagline",
+    ]
+
+    report = compare_backends(MODEL_NAME, chunks, queries, args.backends, k=args.k, repeat=args.repeat)
+    for backend, numbers in report.items():
+        print(backend, numbers)
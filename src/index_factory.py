@@ -0,0 +1,107 @@
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+DEFAULT_INDEX_CONFIG = {
+    "type": "flat",
+    # IVF: number of coarse clusters and how many of them a query visits
+    "nlist": 1024,
+    "nprobe": 16,
+    # IVF-PQ: sub-quantizers per vector (must divide the dimension) and bits each
+    "pq_m": 16,
+    "pq_nbits": 8,
+    # HNSW: graph degree and beam widths at build and query time
+    "hnsw_m": 32,
+    "ef_construction": 200,
+    "ef_search": 64,
+    # Upper bound on vectors sampled for IVF/PQ training
+    "train_size": 100_000,
+}
+
+
+# Parameters that only affect searching; changing them needs no rebuild
+QUERY_TIME_KEYS = ("nprobe", "ef_search")
+
+
+def resolve_config(config=None):
+    resolved = dict(DEFAULT_INDEX_CONFIG)
+    resolved.update(config or {})
+    if resolved["type"] not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {resolved['type']!r}, expected one of {INDEX_TYPES}")
+    return resolved
+
+
+def build_params(config):
+    return {key: value for key, value in config.items() if key not in QUERY_TIME_KEYS}
+
+
+def min_training_points(config):
+    if config["type"] == "ivf_flat":
+        return config["nlist"]
+    if config["type"] == "ivf_pq":
+        return max(config["nlist"], 2 ** config["pq_nbits"])
+    return 0
+
+
+def recommended_training_points(config):
+    # FAISS k-means wants about 39 points per centroid to train well
+    if config["type"] == "ivf_flat":
+        return 39 * config["nlist"]
+    if config["type"] == "ivf_pq":
+        return 39 * max(config["nlist"], 2 ** config["pq_nbits"])
+    return 0
+
+
+def supports_remove(config):
+    # HNSW graphs cannot drop nodes, every other type removes by id
+    return config["type"] != "hnsw"
+
+
+def create_index(config, dimension):
+    """Return an empty index for ``config`` that accepts ``add_with_ids``."""
+    kind = config["type"]
+    if kind == "flat":
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+    if kind == "ivf_flat":
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dimension), dimension, config["nlist"])
+    elif kind == "ivf_pq":
+        index = faiss.IndexIVFPQ(
+            faiss.IndexFlatL2(dimension), dimension, config["nlist"], config["pq_m"], config["pq_nbits"]
+        )
+    else:
+        hnsw = faiss.IndexHNSWFlat(dimension, config["hnsw_m"])
+        hnsw.hnsw.efConstruction = config["ef_construction"]
+        index = faiss.IndexIDMap2(hnsw)
+    apply_search_params(index, config)
+    return index
+
+
+def train_index(index, embeddings, config, seed=0):
+    # Train on a random sample so IVF/PQ training cost stays bounded
+    if index.is_trained:
+        return
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if len(embeddings) > config["train_size"]:
+        rng = np.random.default_rng(seed)
+        embeddings = embeddings[rng.choice(len(embeddings), config["train_size"], replace=False)]
+    index.train(embeddings)
+
+
+def apply_search_params(index, config=None, nprobe=None, ef_search=None):
+    """Set query-time knobs (IVF ``nprobe``, HNSW ``efSearch``) on ``index``.
+
+    Explicit ``nprobe``/``ef_search`` win over the values in ``config``.
+    FAISS does not store these in the index file, so they are applied again
+    every time an index is loaded.
+    """
+    config = config or {}
+    kind = config.get("type")
+    nprobe = nprobe if nprobe is not None else config.get("nprobe")
+    ef_search = ef_search if ef_search is not None else config.get("ef_search")
+
+    parameters = faiss.ParameterSpace()
+    if kind in ("ivf_flat", "ivf_pq") and nprobe is not None:
+        parameters.set_index_parameter(index, "nprobe", int(nprobe))
+    elif kind == "hnsw" and ef_search is not None:
+        parameters.set_index_parameter(index, "efSearch", int(ef_search))
@@ -0,0 +1,355 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import shutil
+import time
+import zlib
+
+import faiss
+import numpy as np
+
+from chunking import chunk_text, content_hash
+from doc_store import DocumentStoreWriter
+from embedding_store import EmbeddingWriter
+from encoders import embed_batches
+from index_factory import (
+    create_index,
+    min_training_points,
+    recommended_training_points,
+    resolve_config,
+    train_index,
+)
+from lexical_index import LexicalIndexBuilder
+from partitions import PARTITIONS_FOLDER, PartitionWriter, build_partition_indexes
+from tagging import category_of
+
+BUILD_SUFFIX = ".building"
+CHECKPOINT_FILE = "checkpoint.json"
+MANIFEST_FILE = "manifest.json"
+
+
+# ── Sources ───────────────────────────────────────────────────────────────────
+# Every source yields records: {"source_file", "text", "offset", "whole_file"}.
+# Whole text files are chunked on their sections; JSONL/CSV rows are one
+# catalog entry each, with the byte offset (JSONL) or row number (CSV) of the
+# row as their offset.
+
+def record_text(row, fields=None):
+    # A "text" column is used as is, other rows become "Key: value" lines
+    # like the hand-written knowledge base files
+    if fields is None and "text" in row:
+        return str(row["text"])
+    keys = fields or list(row)
+    return "\n".join(f"{key}: {row[key]}" for key in keys if row.get(key) not in (None, ""))
+
+
+def iter_text_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        yield {"source_file": os.path.basename(path), "text": f.read(), "offset": 0, "whole_file": True}
+
+
+def iter_directory(folder):
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith(".txt"):
+            yield from iter_text_file(os.path.join(folder, filename))
+
+
+def iter_jsonl(path, fields=None):
+    source = os.path.basename(path)
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            line_offset = offset
+            offset += len(line)
+            if line.strip():
+                row = json.loads(line)
+                yield {"source_file": source, "text": record_text(row, fields), "offset": line_offset, "whole_file": False}
+
+
+def iter_csv(path, fields=None):
+    source = os.path.basename(path)
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        for row_number, row in enumerate(csv.DictReader(f)):
+            yield {"source_file": source, "text": record_text(row, fields), "offset": row_number, "whole_file": False}
+
+
+def iter_sources(paths, fields=None):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from iter_directory(path)
+        elif path.endswith(".jsonl"):
+            yield from iter_jsonl(path, fields)
+        elif path.endswith(".csv"):
+            yield from iter_csv(path, fields)
+        elif path.endswith(".txt"):
+            yield from iter_text_file(path)
+        else:
+            raise ValueError(f"Don't know how to ingest {path!r}, expected a folder, .txt, .jsonl or .csv")
+
+
+def shard_of(record, shard_count):
+    # Stable across runs and processes, unlike hash(); whole text files
+    # have offset 0 and so land in one shard together
+    return zlib.crc32(f"{record['source_file']}:{record['offset']}".encode("utf-8")) % shard_count
+
+
+def iter_chunks(records, manifest_files=None):
+    """Chunk records in stream order; a chunk's position is its vector id.
+
+    Whole text files are recorded in ``manifest_files`` with the same
+    per-file/per-chunk hashes ``vector_store.build_and_save_index`` uses
+    for incremental rebuilds. Catalog rows are numbered per source file.
+    """
+    next_id = 0
+    row_chunks = {}
+    for record in records:
+        source = record["source_file"]
+        chunks = chunk_text(record["text"], source)
+
+        if record["whole_file"]:
+            if manifest_files is not None:
+                manifest_files[source] = {
+                    "hash": content_hash(record["text"]),
+                    "chunks": [{"hash": content_hash(c["text"]), "id": next_id + i} for i, c in enumerate(chunks)],
+                }
+        else:
+            for chunk in chunks:
+                chunk["chunk_id"] = row_chunks.get(source, 0)
+                chunk["offset"] = record["offset"]
+                row_chunks[source] = chunk["chunk_id"] + 1
+
+        next_id += len(chunks)
+        yield from chunks
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ── Streaming build ───────────────────────────────────────────────────────────
+
+def _source_fingerprint(paths):
+    # A checkpoint is only resumed if the inputs are byte-for-byte the same size/mtime
+    fingerprint = []
+    for path in paths:
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+        for name in files:
+            stat = os.stat(name)
+            fingerprint.append([name, stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def _load_checkpoint(staging):
+    path = os.path.join(staging, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_checkpoint(staging, index, writer, lexical, partitions, embedding_writer, checkpoint):
+    tmp_path = os.path.join(staging, "index.faiss.tmp")
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, os.path.join(staging, "index.faiss"))
+    checkpoint["store"] = writer.checkpoint()
+    checkpoint["lexical"] = lexical.checkpoint()
+    checkpoint["partitions"] = partitions.checkpoint()
+    checkpoint["embeddings"] = embedding_writer.checkpoint()
+
+    tmp_path = os.path.join(staging, CHECKPOINT_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, os.path.join(staging, CHECKPOINT_FILE))
+
+
+def add_to_partitions(partitions, chunks, ids, embeddings):
+    rows_by_category = {}
+    for row, chunk in enumerate(chunks):
+        rows_by_category.setdefault(category_of(chunk["source_file"]), []).append(row)
+    for category, rows in rows_by_category.items():
+        partitions.add(category, np.asarray(ids)[rows], embeddings[rows])
+
+
+def _append(index, writer, lexical, partitions, embedding_writer, chunks, embeddings):
+    ids = []
+    for chunk in chunks:
+        ids.append(writer.append(chunk))
+        lexical.add(ids[-1], chunk["text"])
+    ids = np.array(ids, dtype=np.int64)
+    index.add_with_ids(embeddings, ids)
+    add_to_partitions(partitions, chunks, ids, embeddings)
+    # Ids are handed out consecutively, so row i of the matrix is id i
+    embedding_writer.append(embeddings)
+
+
+def stream_build(paths, folder, encoder, encoder_id, index_config=None,
+                 batch_size=256, checkpoint_every=200, fields=None, resume=True, shard=None,
+                 embeddings_dtype="float32"):
+    """Build a fresh index in ``folder`` from ``paths`` with bounded memory.
+
+    Sources are read through generators, chunked, embedded ``batch_size``
+    chunks at a time and appended straight into the FAISS index and the
+    document store. Only the batches being encoded are held in memory, plus
+    for IVF types a training sample of at most ``train_size`` vectors.
+    ``encoder`` may be a model or an ``encoders.ParallelEncoder`` to embed
+    batches on several processes. The build runs in ``<folder>.building``
+    and is moved into ``folder`` when it completes. Every
+    ``checkpoint_every`` batches the partial index and store are saved, and
+    a later call with the same sources, encoder and config resumes from
+    there instead of re-embedding. The BM25 index of ``lexical_index`` is
+    built in the same pass, spilling sorted posting runs to ``folder`` so it
+    stays within a fixed memory budget too, and is checkpointed with the
+    rest. The per-category partitions used by filtered searches are appended
+    as the index grows, and so is the raw embedding matrix
+    (``embedding_store``, stored as ``embeddings_dtype``) that later index
+    rebuilds start from.
+
+    ``shard=(number, count)`` only indexes the records ``shard_of`` assigns
+    to shard ``number`` of ``count``, so the shards of one corpus can be
+    built independently, see ``shards.build_shards``.
+    """
+    started = time.perf_counter()
+    requested = resolve_config(index_config)
+    staging = folder.rstrip("/\\") + BUILD_SUFFIX
+    fingerprint = _source_fingerprint(paths)
+
+    identity = {"encoder": encoder_id, "requested": requested, "sources": fingerprint, "fields": fields,
+                "shard": list(shard) if shard else None, "embeddings_dtype": embeddings_dtype}
+
+    checkpoint = _load_checkpoint(staging) if resume else None
+    if checkpoint is not None and (any(checkpoint.get(key) != value for key, value in identity.items())
+                                   or "lexical" not in checkpoint):
+        checkpoint = None
+
+    if checkpoint is None:
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        config = requested
+        index = None
+        writer = DocumentStoreWriter(staging)
+        lexical = LexicalIndexBuilder(staging)
+        partitions = PartitionWriter(staging)
+        embedding_writer = EmbeddingWriter(staging, encoder_id, embeddings_dtype)
+        done = 0
+        checkpoint = identity
+    else:
+        config = checkpoint["index"]
+        index = faiss.read_index(os.path.join(staging, "index.faiss"))
+        writer = DocumentStoreWriter(staging, checkpoint["store"])
+        lexical = LexicalIndexBuilder(staging, checkpoint["lexical"])
+        partitions = PartitionWriter(staging, checkpoint["partitions"])
+        embedding_writer = EmbeddingWriter(staging, encoder_id, embeddings_dtype, checkpoint["embeddings"])
+        done = checkpoint["chunks"]
+        print(f"Resuming interrupted build after {done} chunks...")
+
+    manifest_files = {}
+    records = iter_sources(paths, fields)
+    if shard is not None:
+        records = (record for record in records if shard_of(record, shard[1]) == shard[0])
+    chunks = iter_chunks(records, manifest_files)
+    # Skip what the checkpoint already holds; the manifest entries still fill in
+    for _ in itertools.islice(chunks, done):
+        pass
+    resumed = done
+
+    # IVF/PQ need training before the first add, so early batches wait here
+    training_target = min(config["train_size"], recommended_training_points(config)) if index is None else 0
+    waiting = []
+
+    def flush_waiting(index, config):
+        if index is None:
+            count = sum(len(batch) for batch, _ in waiting)
+            if count < min_training_points(config):
+                print(f"Only {count} chunks, too few to train {config['type']}; using a flat index")
+                config = resolve_config(dict(config, type="flat"))
+            index = create_index(config, encoder.get_sentence_embedding_dimension())
+            if waiting and not index.is_trained:
+                print(f"Training {config['type']} index on {count} vectors...")
+                train_index(index, np.concatenate([e for _, e in waiting]), config)
+        for batch, embeddings in waiting:
+            _append(index, writer, lexical, partitions, embedding_writer, batch, embeddings)
+        waiting.clear()
+        return index, config
+
+    print("Streaming chunks into the index...")
+    for batch_number, (batch, embeddings) in enumerate(embed_batches(encoder, batched(chunks, batch_size)), start=1):
+        waiting.append((batch, embeddings))
+        if index is None and sum(len(b) for b, _ in waiting) < training_target:
+            continue
+
+        index, config = flush_waiting(index, config)
+        done = writer.count
+        if batch_number % checkpoint_every == 0:
+            _write_checkpoint(staging, index, writer, lexical, partitions, embedding_writer,
+                              dict(checkpoint, index=config, chunks=done))
+            print(f"  {done} chunks embedded ({(done - resumed) / (time.perf_counter() - started):.0f}/s)")
+
+    index, config = flush_waiting(index, config)
+    writer.close()
+    partitions.close()
+    build_partition_indexes(staging, config)
+    embedding_writer.close(index.d)
+    lexical.save()
+    faiss.write_index(index, os.path.join(staging, "index.faiss"))
+    with open(os.path.join(staging, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({"model": encoder_id, "index": config, "next_id": writer.count, "free_ids": [],
+                   "files": manifest_files}, f)
+
+    if os.path.exists(os.path.join(staging, CHECKPOINT_FILE)):
+        os.remove(os.path.join(staging, CHECKPOINT_FILE))
+    os.makedirs(folder, exist_ok=True)
+    shutil.rmtree(os.path.join(folder, PARTITIONS_FOLDER), ignore_errors=True)
+    for name in os.listdir(staging):
+        os.replace(os.path.join(staging, name), os.path.join(folder, name))
+    os.rmdir(staging)
+
+    # Chunks from before an interruption were embedded by an earlier run, count them as kept
+    seconds = time.perf_counter() - started
+    embedded = writer.count - resumed
+    report = {"files_added": len(manifest_files), "files_updated": 0, "files_removed": 0, "files_unchanged": 0,
+              "chunks_embedded": embedded, "chunks_kept": resumed, "chunks_removed": 0,
+              "seconds": round(seconds, 3), "chunks_per_second": round(embedded / seconds, 1)}
+    carried = f", {resumed} more from before the interruption" if resumed else ""
+    print(f"✅ Vector store built: {embedded} chunks in {report['seconds']}s ({report['chunks_per_second']}/s){carried}")
+    return report
+
+
+if __name__ == "__main__":
+    from encoders import ParallelEncoder
+    from vector_store import (
+        BUILD_THREADS_PER_WORKER, BUILD_WORKERS, ENCODER_BACKEND, MODEL_NAME, build_version, get_model, index_config,
+    )
+
+    parser = argparse.ArgumentParser(description="Stream folders, .txt, .jsonl and .csv exports into a fresh index")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--fields", nargs="+", help="JSONL/CSV fields to index (default: 'text' or all fields)")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--checkpoint-every", type=int, default=200, help="batches between checkpoints")
+    parser.add_argument("--fresh", action="store_true", help="ignore any checkpoint from an interrupted build")
+    parser.add_argument("--workers", type=int, default=BUILD_WORKERS,
+                        help=f"encoder processes (default {BUILD_WORKERS})")
+    parser.add_argument("--threads-per-worker", type=int, default=BUILD_THREADS_PER_WORKER,
+                        help=f"torch or ONNX Runtime threads per process (default {BUILD_THREADS_PER_WORKER})")
+    args = parser.parse_args()
+
+    def build(encoder):
+        build_version(
+            args.paths, encoder, index_config(),
+            batch_size=args.batch_size, checkpoint_every=args.checkpoint_every,
+            fields=args.fields, resume=not args.fresh,
+        )
+
+    if args.workers > 1:
+        with ParallelEncoder(MODEL_NAME, ENCODER_BACKEND, args.workers, args.threads_per_worker) as encoder:
+            build(encoder)
+    else:
+        build(get_model())
@@ -1,9 +1,16 @@
 import os
+import asyncio
+import hashlib
+import math
+import random
+import threading
+import time
+import uuid
 import streamlit as st
 from replicate import Client
 import requests
+from requests.adapters import HTTPAdapter
 from PIL import Image
-from io import BytesIO
 
 # Get API token from environment (local) or Streamlit secrets (cloud)
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
@@ -15,50 +22,280 @@ if not REPLICATE_API_TOKEN:
 
 client = Client(api_token=REPLICATE_API_TOKEN)
 
+# Images are named after the SHA-256 of their content and fanned out over
+# two levels of subfolders (generated_images/3f/a2/...), so naming one
+# needs no directory listing, concurrent saves never pick the same name
+# and no folder grows past a few hundred entries
 # Get the directory where this file is located
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 OUTPUT_FOLDER = os.path.join(BASE_DIR, "generated_images")
 
+IMAGE_MODEL = "black-forest-labs/flux-2-pro"
+IMAGE_INPUT = {"width": 1024, "height": 1024}
 
-def get_next_filename():
-    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+# Images are stored in the format Replicate returns them in and written
+# to disk byte for byte. Set IMAGE_FORMAT (e.g. "png", "jpeg", "webp") to
+# store every image in that format instead; only images in another format
+# are then decoded and re-encoded.
+IMAGE_FORMAT = (os.getenv("IMAGE_FORMAT") or "").upper().replace("JPG", "JPEG") or None
+IMAGE_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp"}
 
-    existing_files = [
-        f for f in os.listdir(OUTPUT_FOLDER)
-        if f.startswith("marketing_image_") and f.endswith(".png")
-    ]
+# Generations run as Replicate predictions on one background asyncio loop
+# per process; at most GENERATION_CONCURRENCY are in flight at a time and
+# the rest wait their turn
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "4"))
+GENERATION_TIMEOUT = float(os.getenv("GENERATION_TIMEOUT", "300"))
+PREDICTION_POLL_SECONDS = 1.0
+# Finished jobs are forgotten after this long
+JOB_RETENTION_SECONDS = 3600
+# Aspect ratios walked by aspect-ratio variants, each rendered at about
+# one megapixel
+VARIANT_ASPECT_RATIOS = ("1:1", "4:5", "9:16", "16:9")
 
-    if not existing_files:
-        return os.path.join(OUTPUT_FOLDER, "marketing_image_1.png")
+# Image downloads: (connect, read) timeouts in seconds, attempts for
+# connection errors, timeouts and 429/5xx answers with exponential backoff
+# between them, and the largest body accepted
+DOWNLOAD_TIMEOUT = (5.0, 60.0)
+DOWNLOAD_ATTEMPTS = 3
+DOWNLOAD_BACKOFF_SECONDS = 0.5
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
-    numbers = [
-        int(f.split("_")[-1].split(".")[0])
-        for f in existing_files
-    ]
 
-    next_number = max(numbers) + 1
-    return os.path.join(OUTPUT_FOLDER, f"marketing_image_{next_number}.png")
+def _download_session():
+    # One keep-alive connection pool for every download in the process,
+    # sized for the generations that can finish at the same time
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=GENERATION_CONCURRENCY)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 
-def generate_marketing_image(prompt):
+_downloads = _download_session()
+
+
+def image_path(digest, extension=".png"):
+    return os.path.join(OUTPUT_FOLDER, digest[:2], digest[2:4], f"marketing_image_{digest[:32]}{extension}")
+
+
+def download_to_file(url, path, session=None, timeout=DOWNLOAD_TIMEOUT, attempts=DOWNLOAD_ATTEMPTS,
+                     max_bytes=MAX_IMAGE_BYTES):
+    """Stream ``url`` to ``path`` in chunks, return ``(bytes written, SHA-256 hex digest)``.
 
-    output = client.run(
-        "black-forest-labs/flux-2-pro",
-        input={
-            "prompt": prompt,
-            "width": 1024,
-            "height": 1024
-        }
-    )
+    The body goes to ``path + ".part"`` and is renamed into place once
+    complete, so ``path`` never holds a partial image. Connection errors,
+    timeouts and 429/5xx answers are retried up to ``attempts`` times with
+    exponential backoff; a body over ``max_bytes`` raises ``ValueError``.
+    """
+    session = session or _downloads
+    part_path = path + ".part"
+    for attempt in range(1, attempts + 1):
+        try:
+            with session.get(url, stream=True, timeout=timeout) as response:
+                if response.status_code in RETRY_STATUSES and attempt < attempts:
+                    raise requests.HTTPError(f"{response.status_code} from {url}", response=response)
+                response.raise_for_status()
+                if int(response.headers.get("Content-Length") or 0) > max_bytes:
+                    raise ValueError(f"Image is larger than {max_bytes} bytes")
 
-    image_url = output.url
+                size = 0
+                digest = hashlib.sha256()
+                with open(part_path, "wb") as f:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                        size += len(chunk)
+                        if size > max_bytes:
+                            raise ValueError(f"Image is larger than {max_bytes} bytes")
+                        digest.update(chunk)
+                        f.write(chunk)
+            os.replace(part_path, path)
+            return size, digest.hexdigest()
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                requests.HTTPError) as e:
+            retryable = not isinstance(e, requests.HTTPError) or e.response.status_code in RETRY_STATUSES
+            if not retryable or attempt == attempts:
+                raise
+            print(f"⚠ Download failed ({e}), retrying ({attempt}/{attempts - 1})")
+            time.sleep(DOWNLOAD_BACKOFF_SECONDS * 2 ** (attempt - 1))
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
 
-    response = requests.get(image_url)
-    image = Image.open(BytesIO(response.content))
 
-    output_file = get_next_filename()
-    image.save(output_file)
+def _extension(image_format):
+    return IMAGE_EXTENSIONS.get(image_format, f".{image_format.lower()}")
+
+
+def save_image_from_url(image_url):
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    download_path = os.path.join(OUTPUT_FOLDER, f".download-{uuid.uuid4().hex}")
+    _, digest = download_to_file(image_url, download_path)
+    try:
+        # Image.open only parses the header; pixels are decoded on first use
+        with Image.open(download_path) as image:
+            transcode = IMAGE_FORMAT is not None and IMAGE_FORMAT != image.format
+            output_file = image_path(digest, _extension(IMAGE_FORMAT if transcode else image.format))
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            if transcode:
+                if IMAGE_FORMAT == "JPEG" and image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                # Re-encode next to the download, the final name only ever holds a complete file
+                image.save(download_path + ".encoded", format=IMAGE_FORMAT)
+        # Same content gives the same name, so replacing an existing file is harmless
+        os.replace(download_path + ".encoded" if transcode else download_path, output_file)
+    finally:
+        for path in (download_path, download_path + ".encoded"):
+            if os.path.exists(path):
+                os.remove(path)
 
     print("✅ Image saved successfully:", output_file)
 
     return output_file
+
+
+class GenerationJob:
+    """Handle of one background image generation.
+
+    Returned as soon as the job is queued. ``status`` follows the Replicate
+    prediction ("queued" until a slot is free, then "starting",
+    "processing", ...) and ends as "succeeded" with ``path`` set or
+    "failed" with ``error`` set.
+    """
+
+    def __init__(self, prompt, input, label=None):
+        self.id = uuid.uuid4().hex
+        self.prompt = prompt
+        self.input = input
+        self.label = label
+        self.status = "queued"
+        self.prediction_id = None
+        self.path = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._future = None
+
+    def done(self):
+        return self._future.done()
+
+    def result(self, timeout=None):
+        """Block until the image is saved and return its path."""
+        return self._future.result(timeout)
+
+
+class GenerationWorker:
+    """Runs generation jobs on an asyncio loop in a background thread.
+
+    ``submit`` returns a ``GenerationJob`` right away, so Streamlit scripts
+    never block on Replicate; an asyncio semaphore bounds how many
+    predictions run at once.
+    """
+
+    def __init__(self, concurrency=GENERATION_CONCURRENCY):
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._slots = asyncio.Semaphore(concurrency)
+        threading.Thread(target=self._loop.run_forever, name="generation-loop", daemon=True).start()
+
+    def submit(self, prompt, label=None, **input):
+        job = GenerationJob(prompt, dict(IMAGE_INPUT, **input, prompt=prompt), label)
+        with self._lock:
+            self._forget_finished()
+            self.jobs[job.id] = job
+        job._future = asyncio.run_coroutine_threadsafe(self._run(job), self._loop)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def _forget_finished(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished and job.finished < cutoff]:
+            del self.jobs[job_id]
+
+    async def _run(self, job):
+        try:
+            async with self._slots:
+                job.path = await self._generate(job)
+            job.status = "succeeded"
+            return job.path
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e) or type(e).__name__
+            raise
+        finally:
+            job.finished = time.time()
+
+    async def _generate(self, job):
+        prediction = await client.predictions.async_create(model=IMAGE_MODEL, input=job.input)
+        job.prediction_id = prediction.id
+        deadline = time.monotonic() + GENERATION_TIMEOUT
+        while prediction.status not in ("succeeded", "failed", "canceled"):
+            job.status = prediction.status
+            if time.monotonic() > deadline:
+                await prediction.async_cancel()
+                raise TimeoutError(f"Generation took longer than {GENERATION_TIMEOUT:.0f}s")
+            await asyncio.sleep(PREDICTION_POLL_SECONDS)
+            await prediction.async_reload()
+
+        if prediction.status != "succeeded":
+            raise RuntimeError(prediction.error or f"Prediction {prediction.status}")
+        output = prediction.output
+        image_url = output if isinstance(output, str) else output[0]
+        # Download and save off the event loop so other jobs keep polling
+        return await asyncio.to_thread(save_image_from_url, image_url)
+
+
+# One worker per process, shared by every Streamlit session
+@st.cache_resource
+def get_generation_worker():
+    return GenerationWorker()
+
+
+def submit_generation(prompt, **input):
+    """Start generating an image for ``prompt`` and return its job at once.
+
+    Keyword arguments override the model input (``width``, ``height``, ...).
+    """
+    return get_generation_worker().submit(prompt, **input)
+
+
+def size_for_aspect_ratio(aspect_ratio, pixels=1024 * 1024, multiple=32):
+    """``{"width", "height"}`` of about ``pixels`` for e.g. ``"4:5"``."""
+    w, h = (int(part) for part in aspect_ratio.split(":"))
+    width = math.sqrt(pixels * w / h)
+    return {
+        "width": int(round(width / multiple)) * multiple,
+        "height": int(round(width * h / w / multiple)) * multiple,
+    }
+
+
+def submit_variants(prompt, count, vary="seed"):
+    """Start ``count`` generations of the same prompt at once, return their jobs.
+
+    ``vary="seed"`` gives each variant its own seed, ``vary="aspect_ratio"``
+    renders one per ``VARIANT_ASPECT_RATIOS`` entry. The jobs run
+    concurrently up to ``GENERATION_CONCURRENCY``, so a batch that fits
+    takes about as long as its slowest image.
+    """
+    if vary == "seed":
+        first = random.randrange(2 ** 31 - count)
+        variants = [(f"seed {seed}", {"seed": seed}) for seed in range(first, first + count)]
+    elif vary == "aspect_ratio":
+        variants = [(ratio, size_for_aspect_ratio(ratio)) for ratio in VARIANT_ASPECT_RATIOS[:count]]
+    else:
+        raise ValueError(f"Unknown variant mode {vary!r}, expected 'seed' or 'aspect_ratio'")
+    worker = get_generation_worker()
+    return [worker.submit(prompt, label=label, **input) for label, input in variants]
+
+
+def get_generation_job(job_id):
+    return get_generation_worker().get(job_id)
+
+
+def generate_marketing_image(prompt):
+    # Blocking variant for scripts: same queue, waits for the saved file
+    return submit_generation(prompt).result()
@@ -0,0 +1,179 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tagging import parse_filters
+from vector_store import get_index_holder, get_model, search_many_local
+
+# How long the batcher waits for more queries after the first one arrives,
+# and the most queries it answers with one encode + one index search
+BATCH_WINDOW_MS = 5
+MAX_BATCH_SIZE = 64
+
+
+class MicroBatcher:
+    """Merges queries submitted from many threads into batched searches.
+
+    The first query of a batch waits at most ``window`` seconds for others;
+    queries with the same search options are then answered by a single
+    ``search_many_local`` call, i.e. one encoder batch and one index search.
+    """
+
+    def __init__(self, search=search_many_local, window=BATCH_WINDOW_MS / 1000, max_batch=MAX_BATCH_SIZE):
+        self.search = search
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.queries = 0
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, name="micro-batcher", daemon=True).start()
+
+    def submit(self, query, options):
+        """Queue one query; the returned future resolves to its hit list."""
+        future = Future()
+        self._queue.put((query, options, future))
+        return future
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "queries": self.queries,
+            "mean_batch_size": round(self.queries / self.batches, 2) if self.batches else 0.0,
+        }
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            groups = {}
+            for query, options, future in self._collect():
+                groups.setdefault(json.dumps(options, sort_keys=True), []).append((query, future))
+
+            for key, items in groups.items():
+                try:
+                    results = self.search([query for query, _ in items], **json.loads(key))
+                except Exception as e:
+                    for _, future in items:
+                        future.set_exception(e)
+                    continue
+                for (_, future), hits in zip(items, results):
+                    future.set_result(hits)
+                self.batches += 1
+                self.queries += len(items)
+
+
+SEARCH_MODES = ("hybrid", "dense", "lexical")
+
+
+def parse_search_request(request):
+    """Check a /search body and split it into ``(queries, options)``.
+
+    Raises ``ValueError`` for anything ``search_many_local`` would reject or
+    misread, so the caller gets a 400 instead of a 500 or a wrong answer.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("body must be a JSON object")
+    queries = request.get("queries")
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        raise ValueError("queries must be a list of strings")
+
+    options = {key: request.get(key)
+               for key in ("k", "mode", "min_similarity", "min_bm25", "filters", "mmr_lambda")}
+    options = {key: value for key, value in options.items() if value is not None}
+    if "k" in options and (not isinstance(options["k"], int) or isinstance(options["k"], bool) or options["k"] < 1):
+        raise ValueError("k must be a positive integer")
+    if "mode" in options and options["mode"] not in SEARCH_MODES:
+        raise ValueError(f"mode must be one of {SEARCH_MODES}")
+    for key in ("min_similarity", "min_bm25", "mmr_lambda"):
+        if key in options and (not isinstance(options[key], (int, float)) or isinstance(options[key], bool)):
+            raise ValueError(f"{key} must be a number")
+    if "filters" in options:
+        if not isinstance(options["filters"], dict):
+            raise ValueError("filters must be an object")
+        parse_filters(options["filters"])
+    return queries, options
+
+
+class RetrievalHandler(BaseHTTPRequestHandler):
+    # POST /search {"queries": [...], "k": ..., "mode": ..., "min_similarity": ...,
+    #               "min_bm25": ..., "filters": ..., "mmr_lambda": ...}  ->  {"results": [[hit, ...], ...]}
+    # GET /health  ->  batching and index cache counters
+    batcher = None
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._reply(404, {"error": "not found"})
+            return
+        self._reply(200, {"status": "ok", "batching": self.batcher.stats(), "index": get_index_holder().stats()})
+
+    def do_POST(self):
+        if self.path != "/search":
+            self._reply(404, {"error": "not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            queries, options = parse_search_request(request)
+        except (ValueError, TypeError) as e:
+            self._reply(400, {"error": f"bad request: {e}"})
+            return
+
+        futures = [self.batcher.submit(query, options) for query in queries]
+        try:
+            results = [future.result() for future in futures]
+        except Exception as e:
+            self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self._reply(200, {"results": results})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=8765, window_ms=BATCH_WINDOW_MS, max_batch=MAX_BATCH_SIZE):
+    """Load the encoder and index once, then answer searches over HTTP."""
+    print("Loading encoder and index...")
+    get_model()
+    search_many_local(["warm-up query"], k=1)
+
+    RetrievalHandler.batcher = MicroBatcher(window=window_ms / 1000, max_batch=max_batch)
+    server = ThreadingHTTPServer((host, port), RetrievalHandler)
+    server.daemon_threads = True
+    print(f"✅ Retrieval server listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve vector store searches to the app's worker processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--window-ms", type=float, default=BATCH_WINDOW_MS, help="micro-batch collection window")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH_SIZE)
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.window_ms, args.max_batch)
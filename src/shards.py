@@ -0,0 +1,291 @@
+import argparse
+import atexit
+import json
+import multiprocessing
+import os
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from doc_store import atomic_write
+from encoders import load_encoder
+from ingest import BUILD_SUFFIX, stream_build
+from lexical_index import corpus_stats, tokenize
+from snapshots import (
+    build_lock,
+    collect_garbage,
+    current_folder,
+    new_version_name,
+    publish,
+    unfinished_version,
+    version_folder,
+)
+
+# <folder>/shards.json records the shard count; shard n is a complete index
+# (FAISS index, documents, BM25, partitions) of its own, versioned and
+# published under <folder>/shard-<n> like the single index (see
+# snapshots.py), so a shard is rebuilt while its worker keeps serving.
+# Hit ids are global: shard number in the high bits, the id inside the
+# shard in the low SHARD_ID_BITS.
+SHARDS_FILE = "shards.json"
+SHARD_ID_BITS = 40
+# BM25 statistics of the whole corpus; every shard scores with them so
+# their scores can be merged and thresholded like those of one index
+LEXICAL_STATS_FILE = "lexical_stats.json"
+
+
+def shards_exist(folder):
+    return os.path.exists(os.path.join(folder, SHARDS_FILE))
+
+
+def shard_folder(folder, number):
+    return os.path.join(folder, f"shard-{number:03d}")
+
+
+def global_id(number, doc_id):
+    return (number << SHARD_ID_BITS) | doc_id
+
+
+def published_shard_folder(folder, number):
+    # Shards built before versioning keep their files in the shard folder itself
+    root = shard_folder(folder, number)
+    return current_folder(root) or root
+
+
+# ── Building ──────────────────────────────────────────────────────────────────
+
+def _build_shard(paths, folder, number, count, model_name, backend, encoder_id, index_config, batch_size, threads,
+                 embeddings_dtype):
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    if backend == "torch":
+        import torch
+        torch.set_num_threads(threads)
+    from vector_store import INDEX_VERSION_GRACE_SECONDS
+
+    encoder = load_encoder(model_name, backend, threads)
+    root = shard_folder(folder, number)
+    with build_lock(root):
+        name = unfinished_version(root, BUILD_SUFFIX) or new_version_name()
+        report = stream_build(paths, version_folder(root, name), encoder, encoder_id, index_config,
+                              batch_size=batch_size, shard=(number, count), embeddings_dtype=embeddings_dtype)
+        publish(root, name)
+        collect_garbage(root, INDEX_VERSION_GRACE_SECONDS)
+    return report
+
+
+def build_shards(paths, folder, count, model_name, backend, encoder_id, index_config=None,
+                 only=None, processes=None, batch_size=256, threads_per_shard=1, embeddings_dtype="float32"):
+    """Build ``count`` shards of ``paths`` in parallel, one process per shard.
+
+    Each shard is an ordinary ``ingest.stream_build`` over the records
+    ``ingest.shard_of`` assigns to it into a new version of the shard,
+    published when it completes, so it is resumable on its own and
+    ``only=[2, 5]`` rebuilds just those shards while the running workers
+    keep serving the old versions. Returns the build reports by shard
+    number.
+    """
+    if only is not None and shards_exist(folder):
+        with open(os.path.join(folder, SHARDS_FILE), "r", encoding="utf-8") as f:
+            if json.load(f)["count"] != count:
+                raise ValueError(f"{folder} has a different shard count, rebuild all shards to change it")
+    numbers = sorted(only) if only is not None else list(range(count))
+    os.makedirs(folder, exist_ok=True)
+
+    started = time.perf_counter()
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(min(processes or len(numbers), len(numbers))) as pool:
+        pending = {
+            number: pool.apply_async(_build_shard, (paths, folder, number, count, model_name, backend, encoder_id,
+                                                    index_config, batch_size, threads_per_shard, embeddings_dtype))
+            for number in numbers
+        }
+        reports = {number: result.get() for number, result in pending.items()}
+
+    header = json.dumps({"count": count, "model": encoder_id}).encode("utf-8")
+    atomic_write(os.path.join(folder, SHARDS_FILE), lambda f: f.write(header))
+    write_lexical_stats(folder, count)
+    chunks = sum(report["chunks_embedded"] for report in reports.values())
+    print(f"✅ {len(numbers)} shards built: {chunks} chunks in {time.perf_counter() - started:.1f}s")
+    return reports
+
+
+def write_lexical_stats(folder, count):
+    """Sum the BM25 statistics of the published shards into ``LEXICAL_STATS_FILE``."""
+    doc_count = 0
+    total_length = 0.0
+    df = Counter()
+    for number in range(count):
+        stats = corpus_stats(published_shard_folder(folder, number))
+        doc_count += stats["doc_count"]
+        total_length += stats["total_length"]
+        df.update(stats["df"])
+    header = {"doc_count": doc_count, "avg_length": total_length / max(doc_count, 1), "df": df}
+    atomic_write(os.path.join(folder, LEXICAL_STATS_FILE), lambda f: f.write(json.dumps(header).encode("utf-8")))
+
+
+# ── Serving ───────────────────────────────────────────────────────────────────
+
+def _serve_shard(folder, connection):
+    # Shard worker: keeps one shard resident and answers candidate requests
+    from vector_store import IndexHolder, retrieve_candidates
+
+    holder = IndexHolder(folder)
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        queries, vectors, k, mode, filters, with_embeddings, lexical_stats = request
+        try:
+            loaded = holder.get()
+            dense, bm25 = retrieve_candidates(loaded, queries, lambda: vectors, k, mode, filters, lexical_stats)
+            ids = sorted({int(i) for ids, _ in dense + bm25 for i in ids})
+            embeddings = dict(zip(ids, loaded.embeddings.vectors(ids))) if with_embeddings else {}
+            connection.send(("ok", dense, bm25, {i: loaded.documents[i] for i in ids}, embeddings))
+        except Exception as e:
+            connection.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class ShardPool:
+    """Scatter-gather coordinator over one worker process per shard.
+
+    ``search`` sends the query texts and their embedding to every shard,
+    each worker searches only its own shard, and the per-shard candidates
+    are merged into global top lists. BM25 is scored with the corpus-wide
+    statistics of ``LEXICAL_STATS_FILE``, sent along for the query terms,
+    so the shards' scores are comparable. A worker that died is restarted
+    on the next search.
+    """
+
+    def __init__(self, folder):
+        with open(os.path.join(folder, SHARDS_FILE), "r", encoding="utf-8") as f:
+            self.count = json.load(f)["count"]
+        self.folder = folder
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [None] * self.count
+        self._lock = threading.Lock()
+        self._lexical_stats = None
+        self._lexical_stats_signature = None
+        for number in range(self.count):
+            self._start(number)
+        atexit.register(self.close)
+
+    def _start(self, number):
+        connection, child = self._context.Pipe()
+        process = self._context.Process(
+            target=_serve_shard, args=(shard_folder(self.folder, number), child),
+            name=f"vector-shard-{number}", daemon=True,
+        )
+        process.start()
+        self._workers[number] = (process, connection)
+
+    def close(self):
+        for worker in self._workers:
+            if worker is not None:
+                process, connection = worker
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+        self._workers = [None] * self.count
+
+    def _query_lexical_stats(self, queries):
+        # Global BM25 statistics restricted to the query terms, reloaded
+        # when a shard rebuild rewrites the file; None for shards built
+        # before it existed, which then score with their own statistics
+        path = os.path.join(self.folder, LEXICAL_STATS_FILE)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self._lexical_stats_signature:
+            with open(path, "r", encoding="utf-8") as f:
+                self._lexical_stats = json.load(f)
+            self._lexical_stats_signature = signature
+        stats = self._lexical_stats
+        terms = {term for query in queries for term in tokenize(query)}
+        return {"doc_count": stats["doc_count"], "avg_length": stats["avg_length"],
+                "df": {term: stats["df"].get(term, 0) for term in terms}}
+
+    def search(self, queries, vectors, k, lexical_k, mode, filters=None, with_embeddings=False):
+        """Return merged ``(dense, bm25, documents, embeddings)`` like ``retrieve_candidates``.
+
+        The global top ``k`` dense and ``lexical_k`` BM25 candidates are
+        kept; ``documents`` maps their global ids to their chunks, and
+        ``embeddings`` to their stored vectors if ``with_embeddings``.
+        """
+        with self._lock:
+            lexical_stats = self._query_lexical_stats(queries) if mode != "dense" else None
+            request = (queries, vectors, k, mode, filters, with_embeddings, lexical_stats)
+            for number, (process, connection) in enumerate(self._workers):
+                if not process.is_alive():
+                    print(f"⚠ Shard worker {number} exited, restarting it")
+                    self._start(number)
+            for _, connection in self._workers:
+                connection.send(request)
+            replies = [connection.recv() for _, connection in self._workers]
+
+        for number, reply in enumerate(replies):
+            if reply[0] == "error":
+                raise RuntimeError(f"Shard {number} failed: {reply[1]}")
+
+        documents = {}
+        dense = []
+        bm25 = []
+        for position in range(len(queries)):
+            dense_parts, bm25_parts = [], []
+            for number, (_, shard_dense, shard_bm25, _, _) in enumerate(replies):
+                ids, distances = shard_dense[position]
+                dense_parts.append((global_id(number, ids), distances))
+                ids, scores = shard_bm25[position]
+                bm25_parts.append((global_id(number, ids), scores))
+            dense.append(_merge(dense_parts, k, ascending=True))
+            bm25.append(_merge(bm25_parts, lexical_k, ascending=False))
+
+        embeddings = {}
+        for number, (_, _, _, shard_documents, shard_embeddings) in enumerate(replies):
+            for doc_id, document in shard_documents.items():
+                documents[global_id(number, doc_id)] = document
+            for doc_id, vector in shard_embeddings.items():
+                embeddings[global_id(number, doc_id)] = vector
+        return dense, bm25, documents, embeddings
+
+
+def _merge(parts, k, ascending):
+    # Per-shard lists are already sorted, so the global top k is among them
+    ids = np.concatenate([ids for ids, _ in parts]).astype(np.int64)
+    values = np.concatenate([values for _, values in parts]).astype(np.float32)
+    order = np.argsort(values if ascending else -values, kind="stable")[:k]
+    return ids[order], values[order]
+
+
+if __name__ == "__main__":
+    from vector_store import (
+        DATA_FOLDER,
+        EMBEDDINGS_DTYPE,
+        ENCODER_BACKEND,
+        ENCODER_ID,
+        MODEL_NAME,
+        SHARDS_FOLDER,
+        index_config,
+    )
+
+    parser = argparse.ArgumentParser(description="Build a sharded index, one process per shard")
+    parser.add_argument("paths", nargs="*", default=[DATA_FOLDER])
+    parser.add_argument("--shards", type=int, required=True)
+    parser.add_argument("--only", type=int, nargs="+", help="rebuild only these shard numbers")
+    parser.add_argument("--processes", type=int, help="shards built at once (default: all)")
+    parser.add_argument("--threads-per-shard", type=int, default=1, help="torch or ONNX Runtime threads per build process")
+    args = parser.parse_args()
+
+    build_shards(args.paths, SHARDS_FOLDER, args.shards, MODEL_NAME, ENCODER_BACKEND, ENCODER_ID, index_config(),
+                 only=args.only, processes=args.processes, threads_per_shard=args.threads_per_shard,
+                 embeddings_dtype=EMBEDDINGS_DTYPE)
@@ -0,0 +1,171 @@
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Every build writes a complete index folder under <root>/versions/<name>
+# and publishes it by atomically replacing <root>/CURRENT, which holds the
+# name of the live version. Readers resolve CURRENT on each query, so they
+# never see a half-written version. A replaced version is marked RETIRED
+# and deleted by collect_garbage() once its grace period is over, giving
+# processes still reading it time to switch.
+CURRENT_FILE = "CURRENT"
+VERSIONS_FOLDER = "versions"
+RETIRED_FILE = "RETIRED"
+# Held by whichever process is building or publishing under <root>
+LOCK_FILE = ".build.lock"
+
+
+@contextmanager
+def build_lock(root):
+    """Exclusive lock on ``root`` across processes, held while building and publishing.
+
+    Several app processes may start at once with nothing published; the
+    lock makes them build one after the other, and a build never resumes
+    or deletes a staging folder another process is still writing.
+    """
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, LOCK_FILE), "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK gives up after ten seconds, keep waiting
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _write_marker(path, text):
+    # Per-process temp name, like EmbeddingCache.save: publishers must not share one
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def version_folder(root, name):
+    return os.path.join(root, VERSIONS_FOLDER, name)
+
+
+def current_version(root):
+    """Name of the published version, or ``None`` before the first publish."""
+    try:
+        with open(os.path.join(root, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def current_folder(root):
+    name = current_version(root)
+    return version_folder(root, name) if name else None
+
+
+def new_version_name():
+    # Sorts by creation time; the random suffix keeps concurrent builds apart
+    return f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{uuid.uuid4().hex[:4]}"
+
+
+def unfinished_version(root, staging_suffix):
+    """Newest version whose build left a staging folder behind, if any."""
+    folder = os.path.join(root, VERSIONS_FOLDER)
+    if not os.path.isdir(folder):
+        return None
+    names = sorted(name[:-len(staging_suffix)] for name in os.listdir(folder) if name.endswith(staging_suffix))
+    return names[-1] if names else None
+
+
+def _link_tree(source, target, skip):
+    os.makedirs(target)
+    for name in os.listdir(source):
+        if name in skip:
+            continue
+        source_path, target_path = os.path.join(source, name), os.path.join(target, name)
+        if os.path.isdir(source_path):
+            _link_tree(source_path, target_path, ())
+            continue
+        try:
+            os.link(source_path, target_path)
+        except OSError:
+            shutil.copy2(source_path, target_path)
+
+
+def new_version(root, base=None, skip=()):
+    """Create an unpublished version folder and return ``(name, folder)``.
+
+    With ``base`` the new version starts as a copy of that folder, made of
+    hard links where the filesystem allows, so unchanged files cost no disk
+    space. Files in it must then only be replaced (write a temporary file
+    and rename it over the target), never rewritten in place, or the base
+    version would change too.
+    """
+    name = new_version_name()
+    folder = version_folder(root, name)
+    if base is None:
+        os.makedirs(folder)
+    else:
+        _link_tree(base, folder, set(skip) | {VERSIONS_FOLDER, CURRENT_FILE, RETIRED_FILE, LOCK_FILE})
+    return name, folder
+
+
+def publish(root, name):
+    """Make version ``name`` the live one and retire the previous version.
+
+    Call it under ``build_lock(root)`` when other processes may publish too.
+    """
+    previous = current_version(root)
+    marker = os.path.join(version_folder(root, name), RETIRED_FILE)
+    if os.path.exists(marker):
+        # Publishing a retired version again, e.g. to roll back
+        os.remove(marker)
+    _write_marker(os.path.join(root, CURRENT_FILE), name)
+    if previous and previous != name and os.path.isdir(version_folder(root, previous)):
+        _write_marker(os.path.join(version_folder(root, previous), RETIRED_FILE), str(time.time()))
+    return previous
+
+
+def discard(root, name):
+    """Delete a version that was never published."""
+    shutil.rmtree(version_folder(root, name), ignore_errors=True)
+
+
+def collect_garbage(root, grace_seconds):
+    """Delete versions retired more than ``grace_seconds`` ago.
+
+    Unpublished versions are left alone, a build may still be writing them.
+    Returns the names of the deleted versions.
+    """
+    folder = os.path.join(root, VERSIONS_FOLDER)
+    if not os.path.isdir(folder):
+        return []
+    current = current_version(root)
+    removed = []
+    for name in sorted(os.listdir(folder)):
+        marker = os.path.join(folder, name, RETIRED_FILE)
+        if name == current or not os.path.exists(marker):
+            continue
+        with open(marker, "r", encoding="utf-8") as f:
+            retired_at = float(f.read())
+        if time.time() - retired_at >= grace_seconds:
+            shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+            removed.append(name)
+    return removed
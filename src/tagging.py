@@ -0,0 +1,88 @@
+import os
+import re
+
+# Attributes inferred from chunk text at build time. Each (attribute, value)
+# pair owns one bit of the chunk's tag mask, in the order listed here, so
+# only append new values to keep existing indexes valid. A value matches
+# when one of its keywords starts a word in the chunk.
+TAG_KEYWORDS = {
+    "platform": {
+        "instagram": ("instagram", "reels"),
+        "linkedin": ("linkedin",),
+        "youtube": ("youtube",),
+        "facebook": ("facebook",),
+    },
+    "audience": {
+        "youth": ("youth", "college", "student", "teen"),
+        "professionals": ("professional", "office", "corporate"),
+        "enthusiasts": ("enthusiast",),
+    },
+    "season": {
+        "summer": ("summer",),
+        "winter": ("winter",),
+        "festive": ("festive", "festival", "diwali", "wedding"),
+        "monsoon": ("monsoon",),
+    },
+}
+
+# "category" comes from the source file instead, see category_of()
+ATTRIBUTES = ("category",) + tuple(TAG_KEYWORDS)
+
+TAG_BITS = {}
+for _attribute, _values in TAG_KEYWORDS.items():
+    for _value in _values:
+        TAG_BITS[(_attribute, _value)] = 1 << len(TAG_BITS)
+
+_PATTERNS = {
+    key: re.compile(r"\b(?:" + "|".join(map(re.escape, TAG_KEYWORDS[key[0]][key[1]])) + ")")
+    for key in TAG_BITS
+}
+
+
+def category_of(source_file):
+    # "mens_wear.txt" -> "mens_wear"
+    return os.path.splitext(os.path.basename(source_file))[0]
+
+
+def chunk_tags(text):
+    """Return the tag mask of a chunk's text."""
+    text = text.lower()
+    mask = 0
+    for key, bit in TAG_BITS.items():
+        if _PATTERNS[key].search(text):
+            mask |= bit
+    return mask
+
+
+def describe_tags(mask):
+    """Turn a tag mask back into ``{"audience": ["youth"], ...}``."""
+    tags = {}
+    for (attribute, value), bit in TAG_BITS.items():
+        if mask & bit:
+            tags.setdefault(attribute, []).append(value)
+    return tags
+
+
+def parse_filters(filters):
+    """Split ``{"category": ..., "audience": "youth", ...}`` into categories and tag masks.
+
+    Each attribute accepts one value or a list of values (any of them
+    matches); different attributes must all match. Returns the set of
+    categories (``None`` for any) and one mask per tag attribute.
+    """
+    categories = None
+    masks = []
+    for attribute, values in (filters or {}).items():
+        if attribute not in ATTRIBUTES:
+            raise ValueError(f"Unknown filter {attribute!r}, expected one of {ATTRIBUTES}")
+        values = [values] if isinstance(values, str) else list(values)
+        if attribute == "category":
+            categories = set(values)
+            continue
+        mask = 0
+        for value in values:
+            if (attribute, value) not in TAG_BITS:
+                raise ValueError(f"Unknown {attribute} {value!r}, expected one of {tuple(TAG_KEYWORDS[attribute])}")
+            mask |= TAG_BITS[(attribute, value)]
+        masks.append(mask)
+    return categories, masks
@@ -0,0 +1,92 @@
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import replicate_llm
+
+BODY = os.urandom(200 * 1024)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Paths: /flaky answers 503 once, then the body; /missing is a 404;
+    # /declared-big announces a body over the cap; /streamed-big sends one
+    # without a Content-Length
+    hits = {}
+
+    def do_GET(self):
+        hits = self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        if self.path == "/flaky" and hits == 1:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path in ("/flaky", "/image"):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+        elif self.path == "/declared-big":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(BODY)))
+            self.end_headers()
+        elif self.path == "/streamed-big":
+            self.send_response(200)
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(BODY)
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(replicate_llm, "DOWNLOAD_BACKOFF_SECONDS", 0)
+    _Handler.hits = {}
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _download(url, path, **kwargs):
+    with requests.Session() as session:
+        return replicate_llm.download_to_file(url, str(path), session=session, **kwargs)
+
+
+def test_download_writes_body_and_digest(server, tmp_path):
+    size, digest = _download(server + "/image", tmp_path / "image")
+    assert size == len(BODY)
+    assert digest == hashlib.sha256(BODY).hexdigest()
+    assert (tmp_path / "image").read_bytes() == BODY
+
+
+def test_retries_on_503(server, tmp_path):
+    size, _ = _download(server + "/flaky", tmp_path / "image")
+    assert size == len(BODY)
+    assert _Handler.hits["/flaky"] == 2
+    assert os.listdir(tmp_path) == ["image"]
+
+
+def test_does_not_retry_404(server, tmp_path):
+    with pytest.raises(requests.HTTPError):
+        _download(server + "/missing", tmp_path / "image")
+    assert _Handler.hits["/missing"] == 1
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("path", ["/declared-big", "/streamed-big"])
+def test_size_cap_removes_part_file(server, tmp_path, path):
+    with pytest.raises(ValueError):
+        _download(server + path, tmp_path / "image", max_bytes=len(BODY) // 2)
+    assert _Handler.hits[path] == 1
+    assert os.listdir(tmp_path) == []
@@ -1,18 +1,115 @@
+import argparse
+import json
 import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
+import requests
 import streamlit as st
 
+from chunking import chunk_text, content_hash
+from doc_store import DocumentStore, atomic_write, document_store_exists, patch_document_store
+from doc_store import FILES as DOCUMENT_STORE_FILES
+from diversity import mmr
+from embedding_cache import EmbeddingCache, normalize_query
+from embedding_store import EMBEDDINGS_FILE, EMBEDDINGS_HEADER, EmbeddingStore, embeddings_exist, patch_embeddings
+from encoders import ParallelEncoder, embed_batches, load_encoder
+from index_factory import (
+    INDEX_TYPES,
+    apply_search_params,
+    build_params,
+    create_index,
+    min_training_points,
+    resolve_config,
+    supports_remove,
+    train_index,
+)
+from ingest import BUILD_SUFFIX, add_to_partitions, batched, stream_build
+from lexical_index import FILES as LEXICAL_INDEX_FILES
+from lexical_index import LexicalIndex, patch_lexical_index, reciprocal_rank_fusion
+from partitions import (PARTITIONS_FILE, PARTITIONS_FOLDER, PartitionUpdate, Partitions, build_partition_indexes,
+                        partitions_exist)
+from shards import ShardPool, shards_exist
+from snapshots import (
+    build_lock,
+    collect_garbage,
+    current_folder,
+    current_version,
+    discard,
+    new_version,
+    new_version_name,
+    publish,
+    unfinished_version,
+    version_folder,
+)
+from tagging import category_of, parse_filters
+
 DATA_FOLDER = "data"
 INDEX_FOLDER = "vector_index"
+# Each build is published as a new version under INDEX_FOLDER/versions (see
+# snapshots.py); versions replaced longer ago than this are deleted by the
+# next build, so processes still reading them have time to switch
+INDEX_VERSION_GRACE_SECONDS = int(os.getenv("INDEX_VERSION_GRACE_SECONDS", "600"))
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+# "torch" (fp32), "onnx" or "onnx-int8", see encoders.py
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "torch")
+# Vectors from different backends are not mixed in one index or cache
+ENCODER_ID = MODEL_NAME if ENCODER_BACKEND == "torch" else f"{MODEL_NAME}:{ENCODER_BACKEND}"
+MANIFEST_FILE = "manifest.json"
+# Built by shards.py; when present, searches go to its shard workers
+SHARDS_FOLDER = os.path.join(INDEX_FOLDER, "shards")
+# Chunks embedded and added to the index per step, bounds peak build memory
+ENCODE_BATCH_SIZE = 256
+# Encoder processes for index builds and torch threads in each of them
+BUILD_WORKERS = int(os.getenv("BUILD_WORKERS", "1"))
+BUILD_THREADS_PER_WORKER = int(os.getenv("BUILD_THREADS_PER_WORKER", "1"))
+# Raw embeddings are kept next to the index, "float16" halves their size
+EMBEDDINGS_DTYPE = os.getenv("EMBEDDINGS_DTYPE", "float32")
+# IVF-PQ distances are approximate: fetch k times this many candidates and
+# re-rank them exactly against the stored embeddings (1 turns it off)
+EXACT_RERANK_FACTOR = int(os.getenv("EXACT_RERANK_FACTOR", "4"))
+
+# Query embedding cache; set QUERY_CACHE_PATH to keep it across restarts
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH")
+
+# "hybrid" fuses BM25 and dense results, "dense" or "lexical" use one side.
+# BM25 candidates are cheap, so the lexical side looks deeper than k while
+# dense search only fetches the k hits asked for.
+SEARCH_MODE = os.getenv("SEARCH_MODE", "hybrid")
+LEXICAL_CANDIDATES = int(os.getenv("LEXICAL_CANDIDATES", "20"))
 
-# Cache the model to avoid reloading on every interaction
+# search() returns at most SEARCH_MAX_K hits, and only those that clear a
+# threshold: cosine similarity for dense matches (MiniLM vectors are unit
+# length, so similarity = 1 - L2² / 2) or BM25 score for keyword matches
+SEARCH_MAX_K = int(os.getenv("SEARCH_MAX_K", "4"))
+MIN_SIMILARITY = float(os.getenv("MIN_SIMILARITY", "0.3"))
+MIN_BM25 = float(os.getenv("MIN_BM25", "2.0"))
+
+# With MMR_LAMBDA set (e.g. 0.7, see diversity.py) search() fetches
+# MMR_CANDIDATES times k hits and keeps the k most diverse of them, so
+# near-duplicate chunks do not crowd the prompt
+MMR_LAMBDA = float(os.environ["MMR_LAMBDA"]) if os.getenv("MMR_LAMBDA") else None
+MMR_CANDIDATES = int(os.getenv("MMR_CANDIDATES", "4"))
+
+# With RETRIEVAL_SERVER_URL set (e.g. http://127.0.0.1:8765, see
+# retrieval_server.py) searches go to that server and this process never
+# loads the model or index, unless the server cannot be reached.
+RETRIEVAL_SERVER_URL = os.getenv("RETRIEVAL_SERVER_URL")
+RETRIEVAL_SERVER_TIMEOUT = float(os.getenv("RETRIEVAL_SERVER_TIMEOUT", "10"))
+# After a failed request, search in-process for this long before retrying
+RETRIEVAL_SERVER_RETRY_SECONDS = 30
+
+# Cache the model to avoid reloading on every interaction. It is loaded on
+# first use (or by the warm-up thread), so importing this module stays cheap.
 @st.cache_resource
 def get_model():
-    return SentenceTransformer("all-MiniLM-L6-v2")
-
-model = get_model()
+    return load_encoder(MODEL_NAME, ENCODER_BACKEND)
 
 
 def load_all_text_files():
@@ -27,42 +124,755 @@ def load_all_text_files():
     return documents
 
 
-def build_and_save_index():
+def iter_data_files():
+    for filename in sorted(os.listdir(DATA_FOLDER)):
+        if filename.endswith(".txt"):
+            with open(os.path.join(DATA_FOLDER, filename), "r", encoding="utf-8") as f:
+                yield filename, f.read()
+
+
+def load_all_chunks():
+    # Section-level chunks with their (source_file, chunk_id, offset) metadata
+    chunks = []
+
+    for filename, content in iter_data_files():
+        chunks.extend(chunk_text(content, filename))
+
+    return chunks
+
+
+def load_manifest(folder=None):
+    folder = folder or current_folder(INDEX_FOLDER)
+    if folder is None:
+        return None
+    path = os.path.join(folder, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def index_config(folder=None):
+    manifest = load_manifest(folder)
+    return resolve_config(manifest.get("index") if manifest else None)
+
+
+def build_and_save_index(full=False, index_config=None, workers=None, threads_per_worker=None):
+    """Bring the index in line with DATA_FOLDER, embedding only what changed.
+
+    ``manifest.json`` next to ``index.faiss`` records a content hash per file
+    and per chunk together with the vector id of each chunk. Unchanged files
+    are skipped, chunks whose text is unchanged keep their vector, and
+    vectors of chunks that disappeared are removed from the id-mapped index.
+    Pass ``full=True`` (or ``--full`` on the command line) to start over;
+    from-scratch builds stream through ``ingest.stream_build`` in fixed-size
+    batches and can resume after an interruption.
+
+    Nothing is changed in place: the result is written as a new version
+    (hard links to the unchanged files of the current one) and published
+    atomically, see ``snapshots.py``. Running processes switch to it on
+    their next query.
+
+    ``index_config`` picks the FAISS index type and its parameters (see
+    ``index_factory.DEFAULT_INDEX_CONFIG``); it is stored in the manifest.
+    Changing a build parameter rebuilds the FAISS index from the stored
+    embeddings without encoding anything, changing only
+    ``nprobe``/``ef_search`` just updates the manifest.
+
+    With ``workers`` > 1 (default ``BUILD_WORKERS``) chunks are embedded
+    on a pool of processes, each running ``threads_per_worker`` torch
+    or ONNX Runtime threads. Returns a report with the counts, elapsed time and
+    chunks embedded per second.
+
+    Builds of several processes run one at a time, see ``snapshots.build_lock``.
+    """
+    with build_lock(INDEX_FOLDER):
+        return _build_index(full, index_config, workers, threads_per_worker)
+
+
+def _build_index(full=False, index_config=None, workers=None, threads_per_worker=None):
+    workers = workers or BUILD_WORKERS
+    if workers > 1:
+        threads_per_worker = threads_per_worker or BUILD_THREADS_PER_WORKER
+        print(f"Starting {workers} encoder workers ({threads_per_worker} threads each)...")
+        with ParallelEncoder(MODEL_NAME, ENCODER_BACKEND, workers, threads_per_worker) as encoder:
+            return _update_index(full, index_config, encoder)
+    return _update_index(full, index_config, get_model())
+
+
+def build_version(paths, encoder, index_config=None, **kwargs):
+    """``ingest.stream_build`` into a new index version, then publish it.
+
+    A build that was interrupted left its staging folder behind and is
+    resumed under the same version name.
+    """
+    with build_lock(INDEX_FOLDER):
+        return _build_version(paths, encoder, index_config, **kwargs)
+
+
+def _build_version(paths, encoder, index_config=None, **kwargs):
+    # Only called under build_lock, so any staging folder is from a build that died
+    name = unfinished_version(INDEX_FOLDER, BUILD_SUFFIX) or new_version_name()
+    report = stream_build(paths, version_folder(INDEX_FOLDER, name), encoder, ENCODER_ID, index_config,
+                          embeddings_dtype=EMBEDDINGS_DTYPE, **kwargs)
+    _publish(name)
+    return report
+
+
+def _publish(name):
+    publish(INDEX_FOLDER, name)
+    removed = collect_garbage(INDEX_FOLDER, INDEX_VERSION_GRACE_SECONDS)
+    print(f"✅ Published index version {name}" + (f", deleted {len(removed)} old versions" if removed else ""))
+
+
+def _migrate_legacy_index():
+    # Indexes built before versioning live directly in INDEX_FOLDER: publish
+    # them as the first version instead of re-encoding everything
+    if current_version(INDEX_FOLDER) is not None:
+        return
+    if not os.path.exists(os.path.join(INDEX_FOLDER, MANIFEST_FILE)):
+        return
+    name, _ = new_version(INDEX_FOLDER, base=INDEX_FOLDER, skip=(os.path.basename(SHARDS_FOLDER),))
+    print("Moving the existing index into a versioned folder...")
+    _publish(name)
+
+
+def _write_manifest(folder, manifest):
+    atomic_write(os.path.join(folder, MANIFEST_FILE), lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+
+
+def _write_index(folder, index, manifest):
+    # Replace, never rewrite: the files may be hard links into the published version
+    tmp_path = os.path.join(folder, "index.faiss.tmp")
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, os.path.join(folder, "index.faiss"))
+    _write_manifest(folder, manifest)
+
+
+def _update_index(full, index_config, encoder):
+    started = time.perf_counter()
+    _migrate_legacy_index()
+
+    source = current_folder(INDEX_FOLDER)
+    published = load_manifest(source)
+    manifest = None if full else published
+    rebuild = None
+    if manifest is not None and index_config is not None:
+        requested = resolve_config(index_config)
+        if build_params(requested) != build_params(resolve_config(manifest.get("index"))):
+            if (manifest.get("model") == ENCODER_ID and embeddings_exist(source, ENCODER_ID)
+                    and document_store_exists(source)):
+                print("Index configuration changed, rebuilding it from the stored embeddings...")
+                rebuild = requested
+            else:
+                print("Index configuration changed, rebuilding from scratch...")
+                manifest = None
+        else:
+            manifest = dict(manifest, index=requested)
+
+    if (manifest is None or manifest.get("model") != ENCODER_ID
+            or not os.path.exists(os.path.join(source, "index.faiss")) or not document_store_exists(source)
+            or not partitions_exist(source) or not embeddings_exist(source, ENCODER_ID)):
+        if index_config is None:
+            # Keep the configured index type across --full rebuilds
+            index_config = published.get("index") if published else None
+        return _build_version([DATA_FOLDER], encoder, index_config, batch_size=ENCODE_BATCH_SIZE)
+
+    # The update is written to a new version that starts as hard links to
+    # the current one; files below are replaced, not modified, and only
+    # those with changes, so the others stay links
+    name, folder = new_version(INDEX_FOLDER, base=source)
+    if rebuild is not None:
+        rebuild_index(rebuild, folder)
+        manifest = load_manifest(folder)
+
+    config = resolve_config(manifest.get("index"))
+    store = DocumentStore(folder)
+    index = None  # only read once vectors are added or removed
+    changes = {}  # id -> chunk, or None for a freed id; every other id keeps its stored row
+    stored_embeddings = EmbeddingStore(folder)
+    new_embeddings = []  # (ids, vectors) of every added batch
+    manifest = json.loads(json.dumps(manifest))  # entries below are edited in place
+
+    report = {"files_added": 0, "files_updated": 0, "files_removed": 0, "files_unchanged": 0,
+              "chunks_embedded": 0, "chunks_kept": 0, "chunks_removed": 0}
+    removed_ids = []
+    pending = []  # (chunk, manifest entry) pairs that need a new vector
+    partition_update = PartitionUpdate()
+
     print("Loading clothing data...")
-    documents = load_all_text_files()
+    seen = set()
+    for filename, content in iter_data_files():
+        seen.add(filename)
+        file_hash = content_hash(content)
+        previous = manifest["files"].get(filename)
+        if previous is not None and previous["hash"] == file_hash:
+            report["files_unchanged"] += 1
+            continue
+        report["files_updated" if previous is not None else "files_added"] += 1
+
+        # Reuse vectors of chunks whose text did not change, only metadata moves
+        reusable = {}
+        for entry in previous["chunks"] if previous is not None else []:
+            reusable.setdefault(entry["hash"], []).append(entry["id"])
 
-    print("Generating embeddings...")
-    embeddings = model.encode(documents)
+        entries = []
+        for chunk in chunk_text(content, filename):
+            entry = {"hash": content_hash(chunk["text"]), "id": None}
+            if reusable.get(entry["hash"]):
+                entry["id"] = reusable[entry["hash"]].pop()
+                changes[entry["id"]] = chunk
+                report["chunks_kept"] += 1
+            else:
+                pending.append((chunk, entry))
+            entries.append(entry)
 
-    dimension = embeddings.shape[1]
+        for ids in reusable.values():
+            removed_ids.extend(ids)
+        manifest["files"][filename] = {"hash": file_hash, "chunks": entries}
 
-    index = faiss.IndexFlatL2(dimension)
-    index.add(np.array(embeddings))
+    for filename in sorted(set(manifest["files"]) - seen):
+        report["files_removed"] += 1
+        removed_ids.extend(entry["id"] for entry in manifest["files"].pop(filename)["chunks"])
 
-    if not os.path.exists(INDEX_FOLDER):
-        os.makedirs(INDEX_FOLDER)
+    if rebuild is None and manifest == published:
+        discard(INDEX_FOLDER, name)
+        print(f"✅ Vector store is up to date ({report['files_unchanged']} files unchanged)")
+        report["seconds"] = round(time.perf_counter() - started, 3)
+        report["chunks_per_second"] = 0.0
+        return report
 
-    faiss.write_index(index, f"{INDEX_FOLDER}/index.faiss")
-    np.save(f"{INDEX_FOLDER}/metadata.npy", np.array(documents, dtype=object))
+    if removed_ids:
+        for vector_id in removed_ids:
+            changes[vector_id] = None
+            partition_update.remove(category_of(store.sources[store.meta["source"][vector_id]]), [vector_id])
+        if supports_remove(config):
+            index, _ = load_index(folder)
+            index.remove_ids(np.array(removed_ids, dtype=np.int64))
+        else:
+            print(f"A {config['type']} index cannot remove vectors, rebuilding it from the stored embeddings...")
+            kept = np.setdiff1d(np.flatnonzero(np.asarray(store.meta["source"]) >= 0), removed_ids)
+            index, config = _index_from_embeddings(config, stored_embeddings, kept)
+        manifest["free_ids"].extend(removed_ids)
+        report["chunks_removed"] = len(removed_ids)
 
-    print("✅ Vector store built successfully!")
+    if pending:
+        print(f"Generating embeddings for {len(pending)} chunks...")
+        if index is None:
+            index, _ = load_index(folder)
+    batches = batched(pending, ENCODE_BATCH_SIZE)
+    for batch, embeddings in embed_batches(encoder, batches, text_of=lambda item: item[0]["text"]):
+        # Recycle ids of removed chunks before growing the id space
+        ids = []
+        for chunk, entry in batch:
+            if manifest["free_ids"]:
+                entry["id"] = manifest["free_ids"].pop()
+            else:
+                entry["id"] = manifest["next_id"]
+                manifest["next_id"] += 1
+            changes[entry["id"]] = chunk
+            ids.append(entry["id"])
 
+        index.add_with_ids(embeddings, np.array(ids, dtype=np.int64))
+        add_to_partitions(partition_update, [chunk for chunk, _ in batch], ids, embeddings)
+        new_embeddings.append((ids, embeddings))
+        report["chunks_embedded"] += len(batch)
 
-def load_index():
-    index = faiss.read_index(f"{INDEX_FOLDER}/index.faiss")
-    documents = np.load(f"{INDEX_FOLDER}/metadata.npy", allow_pickle=True)
+    # Only the touched ids are rewritten; the stores copy every other row
+    # over. A store without changes keeps its files, so a query-time
+    # setting such as nprobe only rewrites the manifest
+    if changes:
+        changed = np.array(sorted(changes), dtype=np.int64)
+        replaced = int(np.count_nonzero(np.asarray(store.meta["source"][changed[changed < len(store)]]) >= 0))
+        patch_document_store(folder, changes, manifest["next_id"])
+        patch_lexical_index(folder, changes, replaced)
+    partition_update.save(folder, stored_embeddings.dimension, config)
+    if new_embeddings or removed_ids:
+        patch_embeddings(folder, manifest["next_id"], new_embeddings, removed_ids, ENCODER_ID, EMBEDDINGS_DTYPE)
+    del store, stored_embeddings
+    if index is not None:
+        _write_index(folder, index, dict(manifest, index=config))
+    else:
+        _write_manifest(folder, dict(manifest, index=config))
+    _publish(name)
+
+    seconds = time.perf_counter() - started
+    report["seconds"] = round(seconds, 3)
+    report["chunks_per_second"] = round(report["chunks_embedded"] / seconds, 1)
+    print(
+        f"✅ Vector store updated: {report['chunks_embedded']} embedded, "
+        f"{report['chunks_kept']} kept, {report['chunks_removed']} removed "
+        f"in {report['seconds']}s ({report['chunks_per_second']}/s)"
+    )
+    return report
+
+
+def _index_from_embeddings(config, embeddings, ids):
+    # Fresh index over the stored vectors of ``ids``; IVF types train on a
+    # random sample of them, or fall back to flat when there are too few
+    if len(ids) < min_training_points(config):
+        print(f"Only {len(ids)} chunks, too few to train {config['type']}; using a flat index")
+        config = resolve_config(dict(config, type="flat"))
+    index = create_index(config, embeddings.dimension)
+    if not index.is_trained:
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(ids, min(len(ids), config["train_size"]), replace=False))
+        print(f"Training {config['type']} index on {len(sample)} vectors...")
+        train_index(index, embeddings.vectors(sample), config)
+    for block_ids, vectors in embeddings.iter_blocks(ids):
+        index.add_with_ids(vectors, block_ids)
+    return index, config
+
+
+def rebuild_index(index_config, folder):
+    """Replace the FAISS index in an unpublished version ``folder`` with one
+    of another type or parameters, built from the stored embeddings instead
+    of re-encoding."""
+    started = time.perf_counter()
+    documents = DocumentStore(folder)
+    ids = np.flatnonzero(np.asarray(documents.meta["source"]) >= 0).astype(np.int64)
+    index, config = _index_from_embeddings(resolve_config(index_config), EmbeddingStore(folder), ids)
+
+    build_partition_indexes(folder, config)
+    _write_index(folder, index, dict(load_manifest(folder), index=config))
+    print(f"✅ Rebuilt {config['type']} index from {len(ids)} stored embeddings in {time.perf_counter() - started:.2f}s")
+    return config
+
+
+def load_index(folder=None):
+    folder = folder or current_folder(INDEX_FOLDER)
+    if folder is None:
+        raise FileNotFoundError(f"No index has been published in {INDEX_FOLDER}")
+    index = faiss.read_index(os.path.join(folder, "index.faiss"))
+    documents = DocumentStore(folder)
+    # nprobe/efSearch are not part of the index file, restore them from the manifest
+    apply_search_params(index, index_config(folder))
     return index, documents
 
 
-def search(query, k=2):
-    index, documents = load_index()
+# Everything a search needs, loaded together from one index folder
+LoadedIndex = namedtuple("LoadedIndex", ["index", "documents", "lexical", "partitions", "embeddings", "config"])
+
+
+class IndexHolder:
+    """Keeps the FAISS index and its documents resident between searches.
+
+    For the app's INDEX_FOLDER the published version is looked up on every
+    query; when a build publishes a new one, the next query loads it while
+    concurrent queries keep answering from the old version, so the app picks
+    up new data without a restart or a pause. INDEX_FOLDER is built on
+    demand if nothing was published yet. A holder for another folder (a
+    shard) reloads when the mtime or size of its files change, and raises
+    FileNotFoundError until that folder is built.
+    """
+
+    FILES = ("index.faiss",) + DOCUMENT_STORE_FILES + LEXICAL_INDEX_FILES + (
+        os.path.join(PARTITIONS_FOLDER, PARTITIONS_FILE), EMBEDDINGS_FILE, EMBEDDINGS_HEADER,
+    )
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.loads = 0
+        self.hits = 0
+        self.search_overrides = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._signature = None
+        self._loaded = None
+        self._config = None
+
+    def _file_signature(self):
+        signature = []
+        for name in self.FILES:
+            stat = os.stat(os.path.join(self.folder, name))
+            signature.append((name, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def _resolve(self):
+        # The folder to load and a signature that changes when it must be reloaded
+        name = current_version(self.folder)
+        if name is None and self.folder == INDEX_FOLDER:
+            # No index shipped with the app yet: build it once from DATA_FOLDER.
+            # Other processes starting at the same time wait for that build.
+            with self._load_lock, build_lock(self.folder):
+                if current_version(self.folder) is None:
+                    _build_index()
+            name = current_version(self.folder)
+        if name is not None:
+            return version_folder(self.folder, name), name
+        return self.folder, self._file_signature()
+
+    def get(self):
+        folder, signature = self._resolve()
+        with self._lock:
+            loaded = self._loaded
+            if loaded is not None and signature == self._signature:
+                self.hits += 1
+                return loaded
 
-    query_embedding = model.encode([query])
-    distances, indices = index.search(np.array(query_embedding), k)
+        # Another thread is already loading the new version: keep serving the old one
+        if loaded is not None and not self._load_lock.acquire(blocking=False):
+            with self._lock:
+                self.hits += 1
+            return loaded
+        if loaded is None:
+            self._load_lock.acquire()
+        try:
+            with self._lock:
+                if self._loaded is not None and signature == self._signature:
+                    self.hits += 1
+                    return self._loaded
+            index, documents = load_index(folder)
+            config = index_config(folder)
+            if self.search_overrides:
+                apply_search_params(index, config, **self.search_overrides)
+            loaded = LoadedIndex(index, documents, LexicalIndex(folder),
+                                 Partitions(folder, dict(config, **self.search_overrides)), EmbeddingStore(folder),
+                                 config)
+            with self._lock:
+                self._loaded, self._config, self._signature = loaded, config, signature
+                self.loads += 1
+            return loaded
+        finally:
+            self._load_lock.release()
 
-    results = [documents[i] for i in indices[0]]
+    def tune(self, nprobe=None, ef_search=None):
+        """Override ``nprobe``/``efSearch`` for this process, kept across reloads."""
+        with self._lock:
+            if nprobe is not None:
+                self.search_overrides["nprobe"] = nprobe
+            if ef_search is not None:
+                self.search_overrides["ef_search"] = ef_search
+            if self._loaded is not None:
+                apply_search_params(self._loaded.index, self._config, **self.search_overrides)
+                self._loaded.partitions.search_config.update(self.search_overrides)
+
+    def stats(self):
+        with self._lock:
+            version = self._signature if isinstance(self._signature, str) else None
+            return {"loads": self.loads, "hits": self.hits, "version": version}
+
+
+# One holder per process, shared by every Streamlit session
+@st.cache_resource
+def get_index_holder():
+    return IndexHolder(INDEX_FOLDER)
+
+
+@st.cache_resource
+def _shard_pool():
+    return ShardPool(SHARDS_FOLDER)
+
+
+def get_shard_pool():
+    """The shard coordinator if a sharded index was built, else ``None``."""
+    if not shards_exist(SHARDS_FOLDER):
+        return None
+    return _shard_pool()
+
+
+def index_cache_stats():
+    return get_index_holder().stats()
+
+
+def tune_search(nprobe=None, ef_search=None):
+    get_index_holder().tune(nprobe=nprobe, ef_search=ef_search)
+
+
+@st.cache_resource
+def get_query_cache():
+    return EmbeddingCache(QUERY_CACHE_SIZE, spill_path=QUERY_CACHE_PATH, namespace=ENCODER_ID)
+
+
+def query_cache_stats():
+    return get_query_cache().stats()
+
+
+def encode_queries(queries):
+    """Embed ``queries``, encoding only the ones missing from the query cache."""
+    cache = get_query_cache()
+    vectors = cache.get_many(queries)
+
+    # MiniLM is uncased and whitespace-insensitive, so the normalized text
+    # embeds the same as the original and duplicates are encoded once
+    keys = [normalize_query(q) for q in queries]
+    missing = list(dict.fromkeys(key for key, vector in zip(keys, vectors) if vector is None))
+    if missing:
+        encoded = dict(zip(missing, get_model().encode(missing)))
+        cache.put_many(missing, encoded.values())
+        vectors = [encoded[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+
+    return np.array(vectors, dtype=np.float32)
+
+
+_lexical_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="lexical-search")
+
+
+def _search_reranked(index, embeddings, query_vectors, k):
+    # Over-fetch with the approximate PQ distances, then order the
+    # candidates by their exact L2 distance to the stored vectors
+    _, candidates = index.search(query_vectors, k * EXACT_RERANK_FACTOR)
+    distances = np.full((len(query_vectors), k), np.inf, dtype=np.float32)
+    indices = np.full((len(query_vectors), k), -1, dtype=np.int64)
+    for row, (query, ids) in enumerate(zip(query_vectors, candidates)):
+        ids = ids[ids != -1]
+        exact = ((embeddings.vectors(ids) - query) ** 2).sum(axis=1)
+        order = np.argsort(exact, kind="stable")[:k]
+        distances[row, :len(order)] = exact[order]
+        indices[row, :len(order)] = ids[order]
+    return distances, indices
+
+
+def retrieve_candidates(loaded, queries, embed, k, mode, filters=None, lexical_stats=None):
+    """Dense and BM25 candidates of one ``LoadedIndex`` for each query.
+
+    ``embed()`` returns the query vectors; it is called while the BM25
+    index is searched on a worker thread. Returns two lists with one entry
+    per query: dense ``(ids, distances)`` (up to ``k``) and BM25
+    ``(ids, scores)`` (up to ``LEXICAL_CANDIDATES``), best first. IVF-PQ
+    candidates are re-ranked exactly, see ``EXACT_RERANK_FACTOR``. See
+    ``search_many_local`` for ``mode`` and ``filters``, and
+    ``LexicalIndex.search`` for ``lexical_stats``.
+    """
+    index, documents, lexical, partitions, embeddings, config = loaded
+
+    if filters:
+        categories, tag_masks = parse_filters(filters)
+
+    lexical_future = None
+    if mode in ("hybrid", "lexical"):
+        accept = documents.acceptor(categories, tag_masks) if filters else None
+        lexical_future = _lexical_executor.submit(lexical.search_many, queries, max(k, LEXICAL_CANDIDATES), accept,
+                                                  lexical_stats)
+
+    nothing = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+    dense = [nothing] * len(queries)
+    if mode in ("hybrid", "dense"):
+        if filters:
+            if tag_masks:
+                subsets = documents.by_category(documents.tagged(tag_masks), categories)
+            else:
+                subsets = dict.fromkeys(categories)
+            rerank = EXACT_RERANK_FACTOR if config["type"] == "ivf_pq" else 1
+            distances, indices = partitions.search(embed(), k, subsets, rerank)
+        elif config["type"] == "ivf_pq" and EXACT_RERANK_FACTOR > 1:
+            distances, indices = _search_reranked(index, embeddings, embed(), k)
+        else:
+            distances, indices = index.search(embed(), k)
+        dense = [(row_indices[row_indices != -1], row_distances[row_indices != -1])
+                 for row_distances, row_indices in zip(distances, indices)]
+
+    bm25 = lexical_future.result() if lexical_future else [nothing] * len(queries)
+    return dense, bm25
+
+
+def search_many_local(queries, k=2, mode=None, min_similarity=0.0, min_bm25=0.0, filters=None, mmr_lambda=None):
+    """Run several queries with one encoder batch and one index search.
+
+    In ``"hybrid"`` mode (the default, see ``SEARCH_MODE``) the BM25 index
+    is searched on a worker thread while the queries are embedded and
+    searched in FAISS, and the two rankings are merged with reciprocal-rank
+    fusion. Returns one list of hits per query, best first, each hit a dict
+    with the chunk ``id``, its fused ``score``, its L2 ``distance``, cosine
+    ``similarity`` and ``bm25`` score (``None`` when only the other side
+    found it), the chunk ``text`` and its ``source_file``/``chunk_id``/
+    ``offset`` metadata.
+
+    ``k`` is an upper bound: candidates below ``min_similarity`` or
+    ``min_bm25`` do not take part in the fusion, so a query with nothing
+    relevant in the knowledge base gets fewer hits, or none.
+
+    ``filters`` such as ``{"category": "footwear", "audience": "youth"}``
+    (see ``tagging.ATTRIBUTES``; a list of values matches any of them)
+    restrict both sides before ranking: dense search only scores the
+    matching chunks of the matching category partitions, looked up in the
+    per-tag id lists, and BM25 skips postings of chunks that do not match.
+
+    With ``mmr_lambda`` set, ``MMR_CANDIDATES * k`` hits are fetched and
+    ``diversity.mmr`` keeps ``k`` of them, trading the fused score (scaled
+    to [0, 1]) against the similarity of their stored embeddings to the
+    hits already kept.
+
+    When a sharded index has been built (see ``shards.py``) the queries are
+    embedded here once and scattered to the shard worker processes, and
+    their candidates are merged before fusion.
+    """
+    mode = mode or SEARCH_MODE
+    queries = list(queries)
+    if not queries:
+        return []
+    wanted = k
+    if mmr_lambda is not None:
+        k *= MMR_CANDIDATES
+
+    pool = get_shard_pool()
+    if pool is not None:
+        # Reject a bad filter here with the ValueError a local search raises,
+        # not as a failure of every shard
+        parse_filters(filters)
+        vectors = encode_queries(queries) if mode != "lexical" else None
+        dense, bm25, documents, embeddings = pool.search(queries, vectors, k, max(k, LEXICAL_CANDIDATES), mode,
+                                                         filters, with_embeddings=mmr_lambda is not None)
+
+        def embedding_of(ids):
+            return np.array([embeddings[i] for i in ids], dtype=np.float32)
+    else:
+        loaded = get_index_holder().get()
+        dense, bm25 = retrieve_candidates(loaded, queries, lambda: encode_queries(queries), k, mode, filters)
+        documents = loaded.documents
+        embedding_of = loaded.embeddings.vectors
+
+    results = []
+    for (dense_ids, dense_distances), (bm25_ids, bm25_scores) in zip(dense, bm25):
+        distance_of = dict(zip(dense_ids.tolist(), dense_distances.tolist()))
+        bm25_of = dict(zip(bm25_ids.tolist(), bm25_scores.tolist()))
+        similarity_of = {doc_id: 1 - distance / 2 for doc_id, distance in distance_of.items()}
+        rankings = [
+            [doc_id for doc_id, similarity in similarity_of.items() if similarity >= min_similarity],
+            [doc_id for doc_id, score in bm25_of.items() if score >= min_bm25],
+        ]
+        hits = []
+        for doc_id, score in reciprocal_rank_fusion(rankings, k):
+            document = documents[doc_id]
+            if document is None:
+                continue
+            hits.append({
+                "id": doc_id,
+                "score": score,
+                "distance": distance_of.get(doc_id),
+                "similarity": similarity_of.get(doc_id),
+                "bm25": bm25_of.get(doc_id),
+                **document,
+            })
+        if mmr_lambda is not None and hits:
+            scores = np.array([hit["score"] for hit in hits], dtype=np.float32)
+            order = mmr(scores / scores.max(), embedding_of([hit["id"] for hit in hits]), wanted, mmr_lambda)
+            hits = [hits[i] for i in order]
+        results.append(hits)
     return results
 
 
+_server = {"session": requests.Session(), "down_until": 0.0}
+
+
+def search_many(queries, k=2, mode=None, min_similarity=0.0, min_bm25=0.0, filters=None, mmr_lambda=None):
+    """``search_many_local``, answered by the retrieval server when one is configured.
+
+    If the server is unreachable, times out or answers 5xx, the search runs
+    in this process instead and the server is left alone for
+    RETRIEVAL_SERVER_RETRY_SECONDS. A 4xx means the search itself is wrong
+    (e.g. an unknown filter) and raises ``ValueError`` like a local search.
+    """
+    options = {"k": k, "mode": mode, "min_similarity": min_similarity, "min_bm25": min_bm25, "filters": filters,
+               "mmr_lambda": mmr_lambda}
+    queries = list(queries)
+    if RETRIEVAL_SERVER_URL and queries and time.monotonic() >= _server["down_until"]:
+        try:
+            response = _server["session"].post(
+                f"{RETRIEVAL_SERVER_URL.rstrip('/')}/search",
+                json=dict(options, queries=queries),
+                timeout=RETRIEVAL_SERVER_TIMEOUT,
+            )
+            if 400 <= response.status_code < 500:
+                raise ValueError(f"Retrieval server rejected the search: {response.text}")
+            response.raise_for_status()
+            return response.json()["results"]
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            _server["down_until"] = time.monotonic() + RETRIEVAL_SERVER_RETRY_SECONDS
+            print(f"⚠ Retrieval server unavailable ({e}), searching in-process")
+    return search_many_local(queries, **options)
+
+
+def _score_label(hit):
+    scores = []
+    if hit["similarity"] is not None:
+        scores.append(f"sim={hit['similarity']:.3f}")
+    if hit["bm25"] is not None:
+        scores.append(f"bm25={hit['bm25']:.2f}")
+    return f"{hit['source_file']}#{hit['chunk_id']} ({', '.join(scores)})"
+
+
+def search(query, k=None, min_similarity=None, min_bm25=None, filters=None, mmr_lambda=None):
+    """Return the scored hits for ``query`` that clear the thresholds, best first.
+
+    ``mmr_lambda`` (default ``MMR_LAMBDA``, off when unset) re-ranks them
+    for diversity, see ``search_many_local``.
+
+    The hits and their scores are logged, to tune the thresholds from.
+    """
+    hits = search_many(
+        [query],
+        k or SEARCH_MAX_K,
+        min_similarity=MIN_SIMILARITY if min_similarity is None else min_similarity,
+        min_bm25=MIN_BM25 if min_bm25 is None else min_bm25,
+        filters=filters,
+        mmr_lambda=MMR_LAMBDA if mmr_lambda is None else mmr_lambda,
+    )[0]
+    print(f"Retrieved {len(hits)} chunks for {query!r}: {', '.join(map(_score_label, hits)) or 'none above threshold'}")
+    return hits
+
+
+_warmup_lock = threading.Lock()
+_warmup = {"state": "cold", "error": None, "seconds": None}
+
+
+def _run_warmup():
+    started = time.perf_counter()
+    try:
+        if not RETRIEVAL_SERVER_URL:
+            get_model()
+        search_many(["warm-up query"], k=1)
+    except Exception as e:
+        _warmup.update(state="error", error=str(e))
+        print(f"❌ Vector store warm-up failed: {e}")
+        return
+    _warmup.update(state="ready", seconds=round(time.perf_counter() - started, 3))
+
+
+def start_warmup():
+    """Load the encoder and index in a background thread, once per process.
+
+    With a retrieval server configured this only checks that it answers.
+
+    Safe to call on every script run; only the first call starts a thread.
+    """
+    with _warmup_lock:
+        if _warmup["state"] != "cold":
+            return
+        _warmup["state"] = "loading"
+    threading.Thread(target=_run_warmup, name="vector-store-warmup", daemon=True).start()
+
+
+def warmup_status():
+    """Return ``{"state": "cold" | "loading" | "ready" | "error", ...}``."""
+    return dict(_warmup)
+
+
 if __name__ == "__main__":
-    build_and_save_index()
+    parser = argparse.ArgumentParser(description="Build or update the vector index from DATA_FOLDER")
+    parser.add_argument("--full", action="store_true", help="re-embed everything instead of only changed files")
+    parser.add_argument("--index-type", choices=INDEX_TYPES)
+    parser.add_argument("--nlist", type=int)
+    parser.add_argument("--nprobe", type=int)
+    parser.add_argument("--pq-m", type=int)
+    parser.add_argument("--pq-nbits", type=int)
+    parser.add_argument("--hnsw-m", type=int)
+    parser.add_argument("--ef-construction", type=int)
+    parser.add_argument("--ef-search", type=int)
+    parser.add_argument("--workers", type=int, help=f"encoder processes (default {BUILD_WORKERS})")
+    parser.add_argument("--threads-per-worker", type=int,
+                        help=f"torch or ONNX Runtime threads per process (default {BUILD_THREADS_PER_WORKER})")
+    args = parser.parse_args()
+
+    overrides = {
+        key: value for key, value in vars(args).items()
+        if key not in ("full", "workers", "threads_per_worker") and value is not None
+    }
+    if "index_type" in overrides:
+        overrides["type"] = overrides.pop("index_type")
+    build_and_save_index(
+        full=args.full,
+        index_config=dict(index_config(), **overrides) if overrides else None,
+        workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+    )